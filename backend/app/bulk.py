@@ -0,0 +1,122 @@
+import csv
+import io
+import json
+import os
+
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from . import crud, schemas
+
+# Массовый импорт и экспорт объектов в CSV и NDJSON. Файл читается и пишется
+# построчно, а в БД уходит пачками по IMPORT_CHUNK_SIZE строк.
+IMPORT_CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+EXPORT_FIELDS = [
+    "id", "title", "description", "price", "address", "latitude", "longitude",
+    "status", "agency_id", "realtor_id", "created_at", "updated_at",
+]
+
+
+def detect_format(filename: str | None, content_type: str | None):
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension == ".csv" or (content_type or "").startswith("text/csv"):
+        return "csv"
+    if extension in (".ndjson", ".jsonl") or "ndjson" in (content_type or ""):
+        return "ndjson"
+    return None
+
+
+def _iter_csv(stream):
+    reader = csv.DictReader(stream)
+    for record in reader:
+        # Пустые ячейки считаем отсутствующими, чтобы сработали значения по умолчанию
+        yield reader.line_num, {k: v for k, v in record.items() if k and v not in ("", None)}
+
+
+def _iter_ndjson(stream):
+    for line_num, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_num, e
+            continue
+        yield line_num, record
+
+
+def import_properties(db: Session, fileobj, fmt: str, agency_id: int, realtor_id: int):
+    stream = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    records = _iter_csv(stream) if fmt == "csv" else _iter_ndjson(stream)
+    result = schemas.BulkImportResult(created=0, failed=0, errors=[])
+
+    def report(row, error):
+        result.failed += 1
+        if len(result.errors) < MAX_REPORTED_ERRORS:
+            result.errors.append(schemas.BulkImportError(row=row, error=error))
+
+    def flush(chunk):
+        try:
+            result.created += len(crud.bulk_create_properties(db, [p for _, p in chunk], agency_id, realtor_id))
+        except SQLAlchemyError as e:
+            db.rollback()
+            for row, _ in chunk:
+                report(row, f"Database error: {e.__class__.__name__}")
+
+    chunk = []
+    try:
+        for row, record in records:
+            if isinstance(record, Exception):
+                report(row, f"Invalid JSON: {record}")
+                continue
+            if not isinstance(record, dict):
+                report(row, "Expected an object")
+                continue
+            try:
+                chunk.append((row, schemas.PropertyCreate(**record)))
+            except ValidationError as e:
+                report(row, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+                continue
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                flush(chunk)
+                chunk = []
+    except UnicodeDecodeError:
+        # Дальше читать файл бессмысленно; уже разобранные строки сохраняем
+        report(chunk[-1][0] + 1 if chunk else 0, "File is not valid UTF-8")
+    finally:
+        stream.detach()
+    if chunk:
+        flush(chunk)
+    return result
+
+
+def _export_record(db_property):
+    record = schemas.Property.model_validate(db_property).model_dump(mode="json")
+    return {field: record.get(field) for field in EXPORT_FIELDS}
+
+
+def export_properties(db: Session, fmt: str, agency_id: int | None = None, status: str | None = None):
+    """Генератор кусков CSV/NDJSON для StreamingResponse."""
+    buffer = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+    for db_property in crud.iter_properties(db, agency_id=agency_id, status=status):
+        record = _export_record(db_property)
+        if writer is not None:
+            writer.writerow(record)
+        else:
+            buffer.write(json.dumps(record, ensure_ascii=False) + "\n")
+        # Отдаем клиенту кусками, чтобы не плодить по записи на строку
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
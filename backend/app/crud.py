@@ -1,12 +1,18 @@
-from passlib.context import CryptContext
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-import shutil
-import os
-from sqlalchemy import func
+from datetime import datetime, timedelta
+import base64
+import binascii
+import bisect
+import heapq
+import json
+from sqlalchemy import and_, delete, desc, func, insert, literal, or_, select, text, update
 
-from . import models, schemas
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from . import (
+    geo, models, passwords, pubsub, recurrence, response_cache, rollups, scheduling, schemas, search, storage, versions
+)
+from .cache import principal_cache
+from .database import dialect_insert
 
 
 def get_agency_by_name(db: Session, name: str):
@@ -22,9 +28,10 @@ def create_agency(db: Session, agency: schemas.AgencyCreate):
 
 
 def create_realtor(
-    db: Session, realtor: schemas.RealtorCreate, agency_id: int
+    db: Session, realtor: schemas.RealtorCreate, agency_id: int, hashed_password: str | None = None
 ):
-    hashed_password = pwd_context.hash(realtor.password)
+    if hashed_password is None:
+        hashed_password = passwords.hash_password(realtor.password)
     db_realtor = models.Realtor(
         email=realtor.email,
         full_name=realtor.full_name,
@@ -37,12 +44,59 @@ def create_realtor(
     return db_realtor
 
 
+async def create_realtor_async(db: AsyncSession, realtor: schemas.RealtorCreate, agency_id: int):
+    # Хэш считаем в пуле процессов, не занимая поток из пула FastAPI
+    hashed_password = await passwords.hash_password_async(realtor.password)
+    return await db.run_sync(create_realtor, realtor, agency_id, hashed_password)
+
+
 def get_realtor_by_email(db: Session, email: str):
     return db.query(models.Realtor).filter(models.Realtor.email == email).first()
 
 
+def update_realtor_access(db: Session, realtor_id: int, access: schemas.RealtorAccessUpdate):
+    db_realtor = db.query(models.Realtor).filter(models.Realtor.id == realtor_id).first()
+    if not db_realtor:
+        return None
+    for field, value in access.dict(exclude_none=True).items():
+        setattr(db_realtor, field, value)
+    db.commit()
+    db.refresh(db_realtor)
+    # Сбрасываем закэшированный профиль, чтобы новая роль/блокировка действовали сразу
+    principal_cache.delete(db_realtor.email)
+    return db_realtor
+
+
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return passwords.verify_and_update(plain_password, hashed_password)[0]
+
+
+def _properties_changed(db: Session, agency_id: int, property_ids):
+    """Новые версии для ETag и сброс кэша чтений после коммита. Коммит остается за вызывающим кодом."""
+    versions.bump(
+        db, (versions.SCOPE_AGENCY, agency_id), *((versions.SCOPE_PROPERTY, property_id) for property_id in property_ids)
+    )
+    response_cache.invalidate_on_commit(
+        db,
+        response_cache.tag(response_cache.TAG_AGENCY_PROPERTIES, agency_id),
+        response_cache.tag(response_cache.TAG_ALL_PROPERTIES),
+        *(response_cache.tag(response_cache.TAG_PROPERTY, property_id) for property_id in property_ids),
+    )
+
+
+def _training_events_changed(db: Session):
+    versions.bump(db, (versions.SCOPE_EVENTS, 0))
+    response_cache.invalidate_on_commit(db, response_cache.tag(response_cache.TAG_EVENTS))
+
+
+def _calendar_changed(db: Session, realtor_id: int):
+    agency_id = db.query(models.Realtor.agency_id).filter(models.Realtor.id == realtor_id).scalar()
+    versions.bump(db, (versions.SCOPE_CALENDAR, realtor_id), (versions.SCOPE_AGENCY_CALENDAR, agency_id))
+    response_cache.invalidate_on_commit(
+        db,
+        response_cache.tag(response_cache.TAG_CALENDAR, realtor_id),
+        response_cache.tag(response_cache.TAG_AGENCY_CALENDAR, agency_id),
+    )
 
 
 def create_property(db: Session, property: schemas.PropertyCreate, agency_id: int, realtor_id: int):
@@ -51,23 +105,273 @@ def create_property(db: Session, property: schemas.PropertyCreate, agency_id: in
         description=property.description,
         price=property.price,
         address=property.address,
+        latitude=property.latitude,
+        longitude=property.longitude,
+        geohash=_property_geohash(property.latitude, property.longitude),
         status=property.status,
+        sold_at=rollups.utcnow() if property.status == schemas.PropertyStatusEnum.sold else None,
         agency_id=agency_id,
         realtor_id=realtor_id,
     )
     db.add(db_property)
+    # Объект, запись в поисковом индексе, сводки и история пишутся одной транзакцией
+    db.flush()
+    search.index_property(db, db_property)
+    rollups.apply_changes(db, [(None, rollups.property_snapshot(db_property))])
+    add_property_history_entries(db, [
+        property_history_entry(db_property.id, realtor_id, "create", None, str(property.dict())),
+    ])
+    _properties_changed(db, agency_id, [db_property.id])
     db.commit()
     db.refresh(db_property)
-    add_property_history(db, db_property.id, realtor_id, "create", None, str(property.dict()))
     return db_property
 
 
+def bulk_create_properties(db: Session, properties: list[schemas.PropertyCreate], agency_id: int, realtor_id: int):
+    """Вставляет пачку объектов одним executemany вместе с индексом и историей. Возвращает id."""
+    if not properties:
+        return []
+    now = rollups.utcnow()
+    rows = [
+        {
+            "title": p.title,
+            "description": p.description,
+            "price": p.price,
+            "address": p.address,
+            "latitude": p.latitude,
+            "longitude": p.longitude,
+            "geohash": _property_geohash(p.latitude, p.longitude),
+            "status": models.PropertyStatusEnum(p.status),
+            "sold_at": now if p.status == schemas.PropertyStatusEnum.sold else None,
+            "agency_id": agency_id,
+            "realtor_id": realtor_id,
+        }
+        for p in properties
+    ]
+    ids = db.execute(
+        insert(models.Property).returning(models.Property.id, sort_by_parameter_order=True), rows
+    ).scalars().all()
+    search.index_documents(db, [
+        search.search_document(property_id, p.title, p.description, p.address)
+        for property_id, p in zip(ids, properties)
+    ])
+    rollups.apply_changes(db, [
+        (None, rollups.snapshot(realtor_id, agency_id, row["status"], row["price"], row["sold_at"]))
+        for row in rows
+    ])
+    add_property_history_entries(db, [
+        property_history_entry(property_id, realtor_id, "create", None, str(p.dict()))
+        for property_id, p in zip(ids, properties)
+    ])
+    _properties_changed(db, agency_id, ids)
+    db.commit()
+    return ids
+
+
+def iter_properties(db: Session, agency_id: int | None = None, status: str | None = None, batch_size: int = 500):
+    """Обходит объекты страницами по id, не держа всю выборку в памяти."""
+    last_id = 0
+    while True:
+        query = db.query(models.Property).filter(models.Property.id > last_id)
+        if agency_id is not None:
+            query = query.filter(models.Property.agency_id == agency_id)
+        if status is not None:
+            query = query.filter(models.Property.status == status)
+        batch = query.order_by(models.Property.id).limit(batch_size).all()
+        if not batch:
+            return
+        yield from batch
+        last_id = batch[-1].id
+        # Отпускаем уже отданные объекты, чтобы identity map не росла
+        db.expunge_all()
+
+
+def _property_geohash(latitude: float | None, longitude: float | None):
+    if latitude is None or longitude is None:
+        return None
+    return geo.encode(latitude, longitude)
+
+
 def get_property(db: Session, property_id: int):
     return db.query(models.Property).filter(models.Property.id == property_id).first()
 
 
-def get_properties(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Property).offset(skip).limit(limit).all()
+def _lock_row(db: Session, model, row_id: int):
+    """Строка model по id, заблокированная до конца транзакции; None - строки нет.
+
+    SQLite FOR UPDATE не поддерживает, а pysqlite открывает транзакцию только
+    перед первой записью, поэтому там блокировку на запись берет UPDATE
+    id = id этой строки: следующее чтение уже идет внутри транзакции писателя.
+    UPDATE текстовый: ORM-update добавил бы колонки с onupdate (updated_at).
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        db.execute(text(f"UPDATE {model.__tablename__} SET id = id WHERE id = :id"), {"id": row_id})
+    return db.query(model).filter(model.id == row_id).with_for_update().populate_existing().first()
+
+
+PROPERTY_SORT_KEYS = {
+    "created_at": models.Property.created_at,
+    "price": models.Property.price,
+}
+
+
+def _encode_cursor(payload: dict) -> str:
+    data = json.dumps(payload, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> dict:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()))
+
+
+def encode_property_cursor(sort: str, db_property: models.Property) -> str:
+    value = getattr(db_property, sort)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return _encode_cursor({"s": sort, "v": value, "id": db_property.id})
+
+
+def decode_property_cursor(cursor: str, sort: str):
+    try:
+        payload = _decode_cursor(cursor)
+        if payload["s"] != sort:
+            raise ValueError("Cursor was issued for a different sort order")
+        value = payload["v"]
+        if sort == "created_at" and value is not None:
+            value = datetime.fromisoformat(value)
+        elif sort == "price" and not (value is None or type(value) is int):
+            raise ValueError("Cursor price is not an integer")
+        return int(payload["id"]), value
+    except (KeyError, TypeError, ValueError) as e:
+        # binascii.Error, UnicodeDecodeError и JSONDecodeError - тоже ValueError;
+        # их текст клиенту не отдаем
+        raise ValueError("Invalid cursor") from e
+
+
+def get_properties(
+    db: Session,
+    limit: int = 100,
+    cursor: str | None = None,
+    sort: str = "created_at",
+    descending: bool = True,
+    status: str | None = None,
+    min_price: int | None = None,
+    max_price: int | None = None,
+    agency_id: int | None = None,
+    realtor_id: int | None = None,
+):
+    """Keyset-пагинация по (sort, id). Возвращает (объекты, курсор следующей страницы)."""
+    if sort not in PROPERTY_SORT_KEYS:
+        raise ValueError(f"Unsupported sort key: {sort}")
+    sort_column = PROPERTY_SORT_KEYS[sort]
+
+    query = db.query(models.Property)
+    if status is not None:
+        query = query.filter(models.Property.status == status)
+    if agency_id is not None:
+        query = query.filter(models.Property.agency_id == agency_id)
+    if realtor_id is not None:
+        query = query.filter(models.Property.realtor_id == realtor_id)
+    if min_price is not None:
+        query = query.filter(models.Property.price >= min_price)
+    if max_price is not None:
+        query = query.filter(models.Property.price <= max_price)
+
+    if cursor:
+        cursor_id, cursor_value = decode_property_cursor(cursor, sort)
+        # Сравниваем со значением из курсора: цену строки-курсора могли изменить
+        # между страницами, и сравнение с новой ценой пропустило бы строки.
+        # created_at не меняется, его берем из самой строки, чтобы сравнение шло
+        # с тем, что реально лежит в БД (SQLite хранит DateTime строкой), а
+        # значение из курсора используем, только если строку успели удалить.
+        pivot = cursor_value
+        if sort == "created_at":
+            pivot = db.query(sort_column).filter(models.Property.id == cursor_id).scalar_subquery()
+            pivot = func.coalesce(pivot, cursor_value)
+        if descending:
+            query = query.filter(or_(sort_column < pivot, and_(sort_column == pivot, models.Property.id < cursor_id)))
+        else:
+            query = query.filter(or_(sort_column > pivot, and_(sort_column == pivot, models.Property.id > cursor_id)))
+
+    if descending:
+        query = query.order_by(sort_column.desc(), models.Property.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), models.Property.id.asc())
+
+    # Берем на одну строку больше, чтобы понять, есть ли следующая страница
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_property_cursor(sort, rows[-1])
+    return rows, next_cursor
+
+
+def _query_properties_in_boxes(db: Session, boxes, agency_id: int | None = None, status: str | None = None):
+    # Сначала отсекаем строки по диапазонам геохэша (индекс), затем по точным
+    # границам широты/долготы - ячейки покрытия всегда шире самой области.
+    prefix_filters = []
+    for prefix in geo.cover(boxes):
+        low, high = geo.prefix_range(prefix)
+        prefix_filters.append(and_(models.Property.geohash >= low, models.Property.geohash < high))
+    box_filters = [
+        and_(
+            models.Property.latitude.between(min_lat, max_lat),
+            models.Property.longitude.between(min_lon, max_lon),
+        )
+        for min_lat, min_lon, max_lat, max_lon in boxes
+    ]
+    query = db.query(models.Property).filter(or_(*prefix_filters), or_(*box_filters))
+    if agency_id is not None:
+        query = query.filter(models.Property.agency_id == agency_id)
+    if status is not None:
+        query = query.filter(models.Property.status == status)
+    return query
+
+
+def get_properties_in_bbox(
+    db: Session,
+    min_lat: float,
+    min_lon: float,
+    max_lat: float,
+    max_lon: float,
+    limit: int = 100,
+    agency_id: int | None = None,
+    status: str | None = None,
+):
+    """Объекты внутри прямоугольника карты. min_lon > max_lon означает переход через 180-й меридиан."""
+    if min_lon > max_lon:
+        max_lon += 360
+    boxes = geo.split_bbox(min_lat, min_lon, max_lat, max_lon)
+    query = _query_properties_in_boxes(db, boxes, agency_id=agency_id, status=status)
+    return query.order_by(models.Property.id).limit(limit).all()
+
+
+def get_properties_near(
+    db: Session,
+    latitude: float,
+    longitude: float,
+    radius_km: float,
+    limit: int = 100,
+    agency_id: int | None = None,
+    status: str | None = None,
+):
+    """Объекты в радиусе radius_km от точки, по возрастанию расстояния: [(объект, км)]."""
+    boxes = geo.radius_bbox(latitude, longitude, radius_km)
+    candidates = _query_properties_in_boxes(db, boxes, agency_id=agency_id, status=status).all()
+    results = []
+    for db_property in candidates:
+        distance = geo.haversine_km(latitude, longitude, db_property.latitude, db_property.longitude)
+        if distance <= radius_km:
+            results.append((db_property, distance))
+    results.sort(key=lambda item: (item[1], item[0].id))
+    return results[:limit]
+
+
+def notification_event(notification):
+    """Событие для потока /notifications/stream в формате ответа API."""
+    return schemas.Notification.model_validate(notification).model_dump(mode="json")
 
 
 def create_notification(db: Session, realtor_id: int, message: str):
@@ -75,47 +379,173 @@ def create_notification(db: Session, realtor_id: int, message: str):
     db.add(notification)
     db.commit()
     db.refresh(notification)
+    pubsub.hub.publish([notification_event(notification)])
     return notification
 
 
-def get_notifications(db: Session, realtor_id: int, unread_only: bool = False):
-    query = db.query(models.Notification).filter(models.Notification.realtor_id == realtor_id)
+def _add_notification(db: Session, realtor_id: int, message: str):
+    """Уведомление в текущей транзакции. Коммит остается за вызывающим кодом."""
+    notification = models.Notification(realtor_id=realtor_id, message=message)
+    db.add(notification)
+    db.flush()
+    db.refresh(notification)
+    pubsub.publish_on_commit(db, [notification_event(notification)])
+    return notification
+
+
+def create_agency_notifications(db: Session, agency_id: int, message: str):
+    """Уведомляет всех риэлторов агентства. Коммит остается за вызывающим кодом."""
+    # Одна вставка INSERT ... SELECT на все агентство: число запросов
+    # не зависит от количества риэлторов, и сами риэлторы в память не грузятся.
+    # RETURNING отдает созданные строки для публикации без повторного чтения
+    recipients = select(models.Realtor.id, literal(message)).where(models.Realtor.agency_id == agency_id)
+    rows = db.execute(
+        insert(models.Notification)
+        .from_select([models.Notification.realtor_id, models.Notification.message], recipients)
+        .returning(
+            models.Notification.id,
+            models.Notification.realtor_id,
+            models.Notification.message,
+            models.Notification.is_read,
+            models.Notification.created_at,
+        )
+    ).all()
+    # Подписчики узнают об уведомлениях только после коммита вызывающего кода
+    pubsub.publish_on_commit(db, [notification_event(row) for row in rows])
+    return len(rows)
+
+
+def encode_notification_cursor(notification) -> str:
+    return _encode_cursor({"v": notification.created_at.isoformat(), "id": notification.id})
+
+
+def decode_notification_cursor(cursor: str):
+    try:
+        payload = _decode_cursor(cursor)
+        return int(payload["id"]), datetime.fromisoformat(payload["v"])
+    except (KeyError, TypeError, ValueError, binascii.Error) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def get_notifications(
+    db: Session, realtor_id: int, unread_only: bool = False, limit: int = 50, cursor: str | None = None
+):
+    """Keyset-пагинация по (created_at, id), новые первыми. Возвращает (уведомления, курсор)."""
+    Notification = models.Notification
+    query = db.query(Notification).filter(Notification.realtor_id == realtor_id)
     if unread_only:
-        query = query.filter(models.Notification.is_read == False)
-    return query.order_by(models.Notification.created_at.desc()).all()
+        query = query.filter(Notification.is_read == False)
+    if cursor:
+        cursor_id, cursor_value = decode_notification_cursor(cursor)
+        # Как и у объектов: created_at берем из строки-курсора, если она еще есть
+        pivot = db.query(Notification.created_at).filter(Notification.id == cursor_id).scalar_subquery()
+        pivot = func.coalesce(pivot, cursor_value)
+        query = query.filter(or_(
+            Notification.created_at < pivot,
+            and_(Notification.created_at == pivot, Notification.id < cursor_id),
+        ))
+    rows = query.order_by(Notification.created_at.desc(), Notification.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_notification_cursor(rows[-1])
+    return rows, next_cursor
+
+
+def count_unread_notifications(db: Session, realtor_id: int) -> int:
+    # Читает только частичный индекс ix_notifications_realtor_unread
+    return db.query(func.count(models.Notification.id)).filter(
+        models.Notification.realtor_id == realtor_id,
+        models.Notification.is_read == False,
+    ).scalar()
 
 
 def mark_notification_read(db: Session, notification_id: int, realtor_id: int):
-    notification = db.query(models.Notification).filter(
-        models.Notification.id == notification_id,
-        models.Notification.realtor_id == realtor_id
+    # Один UPDATE ... RETURNING вместо выборки, обновления и перечитывания
+    notification = db.scalars(
+        update(models.Notification)
+        .where(models.Notification.id == notification_id, models.Notification.realtor_id == realtor_id)
+        .values(is_read=True)
+        .returning(models.Notification)
+        .execution_options(synchronize_session=False)
     ).first()
     if notification:
-        notification.is_read = True
         db.commit()
-        db.refresh(notification)
     return notification
 
 
+def mark_notifications_read(db: Session, realtor_id: int, notification_ids: list[int] | None = None) -> int:
+    """Отмечает прочитанными указанные (или все) уведомления одним UPDATE."""
+    query = update(models.Notification).where(
+        models.Notification.realtor_id == realtor_id,
+        models.Notification.is_read == False,
+    )
+    if notification_ids is not None:
+        if not notification_ids:
+            return 0
+        query = query.where(models.Notification.id.in_(notification_ids))
+    result = db.execute(query.values(is_read=True).execution_options(synchronize_session=False))
+    db.commit()
+    return result.rowcount
+
+
+NOTIFICATION_PURGE_BATCH_SIZE = 5000
+
+
+def purge_notifications(db: Session, read_before: datetime, unread_before: datetime) -> int:
+    """Удаляет прочитанные уведомления старше read_before и все старше unread_before.
+
+    Удаляет пачками с коммитом после каждой, чтобы не держать долгую блокировку.
+    """
+    Notification = models.Notification
+    expired = or_(
+        Notification.created_at < unread_before,
+        and_(Notification.is_read == True, Notification.created_at < read_before),
+    )
+    total = 0
+    while True:
+        batch = select(Notification.id).where(expired).limit(NOTIFICATION_PURGE_BATCH_SIZE).scalar_subquery()
+        deleted = db.execute(
+            delete(Notification).where(Notification.id.in_(batch)).execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        total += deleted
+        if deleted < NOTIFICATION_PURGE_BATCH_SIZE:
+            return total
+
+
+SEARCHABLE_FIELDS = {"title", "description", "address"}
+
+
 def update_property(db: Session, property_id: int, property_update: schemas.PropertyUpdate, realtor_id: int):
-    db_property = get_property(db, property_id)
+    # Снимок "до" задает дельты сводных таблиц: параллельный PATCH того же
+    # объекта должен дождаться коммита и увидеть уже новые значения
+    db_property = _lock_row(db, models.Property, property_id)
     if not db_property:
         return None
 
-    old_values = {field: getattr(db_property, field) for field in property_update.dict(exclude_unset=True).keys()}
+    changes = property_update.dict(exclude_unset=True)
+    if changes.get("status") is not None:
+        changes["status"] = models.PropertyStatusEnum(changes["status"])
+    old_values = {field: getattr(db_property, field) for field in changes}
     old_status = db_property.status
+    old_snapshot = rollups.property_snapshot(db_property)
 
     # Обновляем поля
-    for field, value in property_update.dict(exclude_unset=True).items():
+    for field, value in changes.items():
         setattr(db_property, field, value)
-    
-    db.add(db_property)
-    db.commit()
-    db.refresh(db_property)
+    if db_property.status != old_status:
+        db_property.sold_at = rollups.utcnow() if db_property.status == models.PropertyStatusEnum.sold else None
+    rollups.apply_changes(db, [(old_snapshot, rollups.property_snapshot(db_property))])
+    if "latitude" in changes or "longitude" in changes:
+        db_property.geohash = _property_geohash(db_property.latitude, db_property.longitude)
+    if SEARCHABLE_FIELDS & changes.keys():
+        search.index_property(db, db_property)
 
     # Логируем историю
+    history = []
     for field, old_value in old_values.items():
-        new_value = getattr(db_property, field)
+        new_value = changes[field]
         if old_value != new_value:
             action = f"update_{field}"
             # Для enum нужно брать .value
@@ -123,39 +553,171 @@ def update_property(db: Session, property_id: int, property_update: schemas.Prop
                 old_value = old_value.value
             if isinstance(new_value, models.PropertyStatusEnum):
                 new_value = new_value.value
-            
-            add_property_history(db, property_id, realtor_id, action, str(old_value), str(new_value))
+            history.append(property_history_entry(property_id, realtor_id, action, str(old_value), str(new_value)))
+    add_property_history_entries(db, history)
 
     # Создаем уведомление, если статус изменился
     if db_property.status != old_status:
-        agency_realtors = db.query(models.Realtor).filter(models.Realtor.agency_id == db_property.agency_id).all()
-        for realtor in agency_realtors:
-            create_notification(
-                db,
-                realtor_id=realtor.id,
-                message=f"Статус объекта '{db_property.title}' изменен на {db_property.status.value}"
-            )
-
+        create_agency_notifications(
+            db,
+            agency_id=db_property.agency_id,
+            message=f"Статус объекта '{db_property.title}' изменен на {db_property.status.value}"
+        )
+
+    _properties_changed(db, db_property.agency_id, [property_id])
+    # Изменение, его история и уведомления фиксируются одним коммитом
+    db.commit()
+    db.refresh(db_property)
     return db_property
 
 
-def add_property_history(db: Session, property_id: int, realtor_id: int, action: str, old_value: str, new_value: str):
-    history = models.PropertyHistory(
-        property_id=property_id,
-        realtor_id=realtor_id,
-        action=action,
-        old_value=old_value,
-        new_value=new_value,
-    )
-    db.add(history)
-    db.commit()
+def property_history_entry(property_id: int, realtor_id: int, action: str, old_value: str | None, new_value: str | None):
+    return {
+        "property_id": property_id,
+        "realtor_id": realtor_id,
+        "action": action,
+        "old_value": old_value,
+        "new_value": new_value,
+    }
+
+
+def add_property_history_entries(db: Session, entries: list[dict]):
+    """Вставляет записи истории одним executemany. Коммит остается за вызывающим кодом."""
+    if entries:
+        db.execute(insert(models.PropertyHistory), entries)
+
+
+def get_property_version(db: Session, property_id: int):
+    """Версия объекта и его истории для ETag."""
+    return versions.current(db, versions.SCOPE_PROPERTY, property_id)
+
+
+def get_properties_version(db: Session, agency_id: int | None = None):
+    """Версия списков объектов: агентства или всех агентств сразу."""
+    if agency_id is not None:
+        return versions.current(db, versions.SCOPE_AGENCY, agency_id)
+    return versions.scope_total(db, versions.SCOPE_AGENCY)
+
+
+def get_training_events_version(db: Session):
+    return versions.current(db, versions.SCOPE_EVENTS)
 
 
 def get_property_history(db: Session, property_id: int):
     return db.query(models.PropertyHistory).filter(models.PropertyHistory.property_id == property_id).all()
 
 
+# Порог "длинного" события. Короткое событие, пересекающее окно [start, end),
+# обязательно начинается в [start - CALENDAR_LONG_EVENT, end), поэтому такой
+# поиск - это диапазон по индексу (realtor_id, start_time), а не скан всей истории.
+CALENDAR_LONG_EVENT = timedelta(days=1)
+# Насколько вперед новая серия проверяется на пересечения
+CALENDAR_RECURRENCE_HORIZON = timedelta(days=366)
+
+
+def _is_long_event(start_time, end_time):
+    return start_time is not None and end_time is not None and end_time - start_time > CALENDAR_LONG_EVENT
+
+
+def _parse_event_recurrence(text, start_time, end_time):
+    """Правило серии или None; проверяет, что серия с таким временем допустима."""
+    if not text:
+        return None
+    rule = recurrence.parse_rule(text)
+    if end_time - start_time > CALENDAR_LONG_EVENT:
+        # Вхождения ищутся как короткие события, см. _overlapping_events
+        raise ValueError("Recurring events must not be longer than a day")
+    if not recurrence.is_occurrence(rule, start_time, start_time):
+        raise ValueError("start_time must match the recurrence rule")
+    return rule
+
+
+def _apply_recurrence(db_event: models.CalendarEvent, rule):
+    db_event.recurrence = recurrence.format_rule(rule) if rule else None
+    db_event.recurrence_end = (
+        recurrence.series_end(rule, db_event.start_time, db_event.end_time - db_event.start_time) if rule else None
+    )
+
+
+class CalendarConflict(Exception):
+    """Новое время события пересекается с другими событиями."""
+
+    def __init__(self, conflicts):
+        super().__init__("Calendar event overlaps existing events")
+        # Снимок до rollback: после него ORM-объекты истекают
+        self.conflicts = [schemas.CalendarEvent.model_validate(e) for e in conflicts]
+
+
+def _overlaps_any(slots, slot_starts, event):
+    # Вхождения одной длины, поэтому из начавшихся до конца события дальше
+    # всех заканчивается последнее
+    event_start = scheduling.align(event.start_time, slot_starts[0])
+    event_end = scheduling.align(event.end_time, slot_starts[0])
+    index = bisect.bisect_left(slot_starts, event_end) - 1
+    return index >= 0 and slots[index][1] > event_start
+
+
+def find_calendar_conflicts(
+    db: Session,
+    realtor_id: int,
+    property_id: int | None,
+    event_type,
+    start: datetime,
+    end: datetime,
+    exclude_id: int | None = None,
+    rule=None,
+):
+    """События, мешающие поставить [start, end): занятость риэлтора и другие показы того же объекта.
+
+    Для серии (rule) проверяются ее вхождения на CALENDAR_RECURRENCE_HORIZON вперед.
+    """
+    Event = models.CalendarEvent
+    extra = [Event.id != exclude_id] if exclude_id is not None else []
+    slots = None
+    if rule is not None:
+        slots = list(recurrence.occurrences(rule, start, end - start, start, start + CALENDAR_RECURRENCE_HORIZON))
+        end = slots[-1][1]
+    candidates = list(_overlapping_events(db, Event.realtor_id == realtor_id, start, end, *extra))
+    if property_id is not None and models.CalendarEventType(event_type) == models.CalendarEventType.viewing:
+        candidates.extend(_overlapping_events(
+            db, Event.property_id == property_id, start, end,
+            Event.event_type == models.CalendarEventType.viewing, *extra,
+        ))
+    if slots is not None:
+        slot_starts = [slot_start for slot_start, _ in slots]
+        candidates = [e for e in candidates if _overlaps_any(slots, slot_starts, e)]
+    # Вхождения одной серии делят id, поэтому различаем их и по началу
+    conflicts = {(e.id, e.start_time): e for e in candidates}
+    return sorted(conflicts.values(), key=lambda e: (e.start_time, e.id))
+
+
+def _check_calendar_slot(
+    db: Session, realtor_id: int, property_id, event_type, start, end, exclude_id=None, rule=None
+):
+    if start is None or end is None or end <= start:
+        raise ValueError("end_time must be after start_time")
+    # Блокируем строки риэлтора и объекта до конца транзакции, чтобы две
+    # параллельные записи не прошли проверку одновременно. В SQLite _lock_row
+    # берет блокировку всей базы на запись еще до поиска конфликтов
+    _lock_row(db, models.Realtor, realtor_id)
+    if property_id is not None:
+        _lock_row(db, models.Property, property_id)
+    conflicts = find_calendar_conflicts(
+        db, realtor_id, property_id, event_type, start, end, exclude_id=exclude_id, rule=rule
+    )
+    if conflicts:
+        raise CalendarConflict(conflicts)
+
+
 def create_calendar_event(db: Session, event: schemas.CalendarEventCreate, realtor_id: int):
+    try:
+        rule = _parse_event_recurrence(event.recurrence, event.start_time, event.end_time)
+        _check_calendar_slot(
+            db, realtor_id, event.property_id, event.event_type, event.start_time, event.end_time, rule=rule
+        )
+    except Exception:
+        db.rollback()
+        raise
     db_event = models.CalendarEvent(
         property_id=event.property_id,
         event_type=event.event_type,
@@ -163,9 +725,12 @@ def create_calendar_event(db: Session, event: schemas.CalendarEventCreate, realt
         description=event.description,
         start_time=event.start_time,
         end_time=event.end_time,
+        is_long=_is_long_event(event.start_time, event.end_time),
         realtor_id=realtor_id,
     )
+    _apply_recurrence(db_event, rule)
     db.add(db_event)
+    _calendar_changed(db, realtor_id)
     db.commit()
     db.refresh(db_event)
     return db_event
@@ -175,6 +740,126 @@ def get_calendar_events(db: Session, realtor_id: int, skip: int = 0, limit: int
     return db.query(models.CalendarEvent).filter(models.CalendarEvent.realtor_id == realtor_id).offset(skip).limit(limit).all()
 
 
+def _event_sort_key(event):
+    return event.start_time, event.id
+
+
+def _occurrence(series: models.CalendarEvent, original_start, start_time, end_time, exception=None):
+    return schemas.CalendarEvent(
+        id=series.id,
+        realtor_id=series.realtor_id,
+        created_at=series.created_at,
+        property_id=series.property_id,
+        event_type=series.event_type.value,
+        title=exception.title if exception is not None and exception.title else series.title,
+        description=exception.description if exception is not None and exception.description else series.description,
+        start_time=start_time,
+        end_time=end_time,
+        recurrence=series.recurrence,
+        occurrence_start=original_start,
+    )
+
+
+def _series_occurrences(series: models.CalendarEvent, exceptions, start: datetime, end: datetime):
+    """Вхождения серии в окне [start, end) по возрастанию, с учетом исключений."""
+    rule = recurrence.parse_rule(series.recurrence)
+    duration = series.end_time - series.start_time
+    window_start = scheduling.align(start, series.start_time)
+    window_end = scheduling.align(end, series.start_time)
+    moved = []
+    for exception in exceptions.values():
+        if exception.cancelled:
+            continue
+        moved_start = exception.start_time or exception.original_start
+        moved_end = exception.end_time or moved_start + duration
+        if moved_start < window_end and moved_end > window_start:
+            moved.append(_occurrence(series, exception.original_start, moved_start, moved_end, exception))
+    moved.sort(key=_event_sort_key)
+    regular = (
+        _occurrence(series, occurrence_start, occurrence_start, occurrence_end)
+        for occurrence_start, occurrence_end in recurrence.occurrences(rule, series.start_time, duration, start, end)
+        if occurrence_start not in exceptions
+    )
+    return heapq.merge(regular, moved, key=_event_sort_key)
+
+
+def _expand_series(db: Session, series, start: datetime, end: datetime):
+    Exception_ = models.CalendarEventException
+    exceptions = {s.id: {} for s in series}
+    rows = db.query(Exception_).filter(
+        Exception_.event_id.in_(list(exceptions)),
+        or_(
+            # Вхождение по правилу попадает в окно (серии не длиннее суток)
+            and_(Exception_.original_start >= start - CALENDAR_LONG_EVENT, Exception_.original_start < end),
+            # Или перенесено в окно откуда-то еще
+            and_(Exception_.start_time < end, Exception_.end_time > start),
+        ),
+    )
+    for row in rows:
+        exceptions[row.event_id][row.original_start] = row
+    return heapq.merge(
+        *(_series_occurrences(s, exceptions[s.id], start, end) for s in series), key=_event_sort_key
+    )
+
+
+def _overlapping_events(db: Session, scope_filter, start: datetime, end: datetime, *extra_filters):
+    """События и вхождения серий, пересекающиеся с [start, end), по возрастанию начала."""
+    # scope_filter - равенство по realtor_id или property_id, оба индексированы
+    # вместе с (is_long, start_time)
+    Event = models.CalendarEvent
+    overlaps = (Event.start_time < end, Event.end_time > start, *extra_filters)
+    single = Event.recurrence == None
+    short = db.query(Event).filter(
+        scope_filter, single, Event.is_long == False, Event.start_time >= start - CALENDAR_LONG_EVENT, *overlaps
+    )
+    long = db.query(Event).filter(scope_filter, single, Event.is_long == True, *overlaps)
+    events = short.union_all(long).order_by(Event.start_time, Event.id)
+    # Серий у риэлтора немного, и каждая хранится одной строкой; вхождения
+    # разворачиваются лениво и только внутри окна
+    series = db.query(Event).filter(
+        scope_filter,
+        Event.recurrence != None,
+        Event.start_time < end,
+        or_(Event.recurrence_end == None, Event.recurrence_end > start),
+        *extra_filters,
+    ).all()
+    if not series:
+        return iter(events.all())
+    return heapq.merge(events.all(), _expand_series(db, series, start, end), key=_event_sort_key)
+
+
+def get_calendar_events_in_range(db: Session, realtor_id: int, start: datetime, end: datetime):
+    """События риэлтора, пересекающиеся с окном [start, end)."""
+    return list(_overlapping_events(db, models.CalendarEvent.realtor_id == realtor_id, start, end))
+
+
+def get_agency_calendar_events(db: Session, agency_id: int, start: datetime, end: datetime):
+    """События всех риэлторов агентства в окне [start, end) одним запросом."""
+    realtor_ids = select(models.Realtor.id).where(models.Realtor.agency_id == agency_id)
+    return list(_overlapping_events(db, models.CalendarEvent.realtor_id.in_(realtor_ids), start, end))
+
+
+def find_free_slots(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    min_duration: timedelta,
+    realtor_id: int | None = None,
+    property_id: int | None = None,
+):
+    """Окна, свободные одновременно у риэлтора и у объекта (у кого из них задан id)."""
+    Event = models.CalendarEvent
+    busy_streams = []
+    if realtor_id is not None:
+        events = _overlapping_events(db, Event.realtor_id == realtor_id, start, end)
+        busy_streams.append([(e.start_time, e.end_time) for e in events])
+    if property_id is not None:
+        events = _overlapping_events(db, Event.property_id == property_id, start, end)
+        busy_streams.append([(e.start_time, e.end_time) for e in events])
+    busy = scheduling.merge_busy(*busy_streams)
+    return scheduling.free_slots(busy, start, end, min_duration)
+
+
 def get_calendar_event(db: Session, event_id: int, realtor_id: int):
     return db.query(models.CalendarEvent).filter(models.CalendarEvent.id == event_id, models.CalendarEvent.realtor_id == realtor_id).first()
 
@@ -183,8 +868,33 @@ def update_calendar_event(db: Session, event_id: int, event_update: schemas.Cale
     db_event = get_calendar_event(db, event_id, realtor_id)
     if not db_event:
         return None
-    for field, value in event_update.dict(exclude_unset=True).items():
+    changes = event_update.dict(exclude_unset=True)
+    start_time = changes.get("start_time", db_event.start_time)
+    end_time = changes.get("end_time", db_event.end_time)
+    try:
+        rule = _parse_event_recurrence(changes.get("recurrence", db_event.recurrence), start_time, end_time)
+        _check_calendar_slot(
+            db,
+            realtor_id,
+            changes.get("property_id", db_event.property_id),
+            changes.get("event_type", db_event.event_type),
+            start_time,
+            end_time,
+            exclude_id=event_id,
+            rule=rule,
+        )
+    except Exception:
+        db.rollback()
+        raise
+    previous = (db_event.recurrence, db_event.start_time)
+    for field, value in changes.items():
         setattr(db_event, field, value)
+    db_event.is_long = _is_long_event(db_event.start_time, db_event.end_time)
+    _apply_recurrence(db_event, rule)
+    if previous != (db_event.recurrence, db_event.start_time):
+        # Исключения привязаны к вхождениям старого расписания
+        db_event.exceptions.clear()
+    _calendar_changed(db, realtor_id)
     db.commit()
     db.refresh(db_event)
     return db_event
@@ -195,17 +905,79 @@ def delete_calendar_event(db: Session, event_id: int, realtor_id: int):
     if not db_event:
         return False
     db.delete(db_event)
+    _calendar_changed(db, realtor_id)
     db.commit()
     return True
 
 
+def set_calendar_event_exception(
+    db: Session, event_id: int, exception: schemas.CalendarEventExceptionCreate, realtor_id: int
+):
+    """Переносит или отменяет одно вхождение серии; повторный вызов заменяет исключение."""
+    db_event = get_calendar_event(db, event_id, realtor_id)
+    if not db_event:
+        return None
+    try:
+        if not db_event.recurrence:
+            raise ValueError("Calendar event is not recurring")
+        rule = recurrence.parse_rule(db_event.recurrence)
+        # Ключ берем из самого правила, чтобы он совпал с генерируемыми вхождениями
+        original_start = next(recurrence.iter_starts(rule, db_event.start_time, after=exception.original_start), None)
+        if original_start is None or original_start != scheduling.align(exception.original_start, original_start):
+            raise ValueError("original_start is not an occurrence of this event")
+        start_time = end_time = None
+        if not exception.cancelled:
+            duration = db_event.end_time - db_event.start_time
+            start_time = exception.start_time or original_start
+            end_time = exception.end_time or start_time + duration
+            _check_calendar_slot(
+                db, realtor_id, db_event.property_id, db_event.event_type, start_time, end_time, exclude_id=event_id
+            )
+    except Exception:
+        db.rollback()
+        raise
+
+    Exception_ = models.CalendarEventException
+    db_exception = db.query(Exception_).filter(
+        Exception_.event_id == event_id, Exception_.original_start == original_start
+    ).first()
+    if db_exception is None:
+        db_exception = Exception_(event_id=event_id, original_start=original_start)
+        db.add(db_exception)
+    db_exception.cancelled = exception.cancelled
+    db_exception.start_time = start_time
+    db_exception.end_time = end_time
+    db_exception.title = exception.title
+    db_exception.description = exception.description
+    _calendar_changed(db, realtor_id)
+    db.commit()
+    db.refresh(db_exception)
+    return db_exception
+
+
+def delete_calendar_event_exception(db: Session, event_id: int, exception_id: int, realtor_id: int):
+    """Возвращает вхождение к расписанию серии."""
+    if not get_calendar_event(db, event_id, realtor_id):
+        return False
+    deleted = db.query(models.CalendarEventException).filter(
+        models.CalendarEventException.id == exception_id,
+        models.CalendarEventException.event_id == event_id,
+    ).delete(synchronize_session=False)
+    _calendar_changed(db, realtor_id)
+    db.commit()
+    return deleted > 0
+
+
 def create_document(db: Session, doc: schemas.DocumentCreate, realtor_id: int):
     db_doc = models.Document(
         filename=doc.filename,
         filepath=doc.filepath,
         agency_id=doc.agency_id,
         realtor_id=realtor_id,
-        property_id=doc.property_id
+        property_id=doc.property_id,
+        content_type=doc.content_type,
+        size=doc.size,
+        checksum=doc.checksum,
     )
     db.add(db_doc)
     db.commit()
@@ -213,6 +985,52 @@ def create_document(db: Session, doc: schemas.DocumentCreate, realtor_id: int):
     return db_doc
 
 
+def _acquire_blob(db: Session, checksum: str, size: int):
+    # Атомарный upsert счетчика ссылок: параллельные загрузки одного файла
+    # не создадут две записи и не потеряют инкремент
+    statement = dialect_insert(db)(models.DocumentBlob).values(checksum=checksum, size=size, ref_count=1)
+    statement = statement.on_conflict_do_update(
+        index_elements=[models.DocumentBlob.checksum],
+        set_={"ref_count": models.DocumentBlob.ref_count + 1},
+    )
+    db.execute(statement)
+
+
+def _release_blob(db: Session, checksum: str):
+    """Снимает одну ссылку. True, если ссылок не осталось и файл можно удалять."""
+    result = db.execute(
+        update(models.DocumentBlob)
+        .where(models.DocumentBlob.checksum == checksum)
+        .values(ref_count=models.DocumentBlob.ref_count - 1)
+    )
+    if result.rowcount == 0:
+        # Документ загружен до появления хранилища по содержимому - файл только его
+        return True
+    result = db.execute(
+        delete(models.DocumentBlob).where(
+            models.DocumentBlob.checksum == checksum,
+            models.DocumentBlob.ref_count <= 0,
+        )
+    )
+    return result.rowcount > 0
+
+
+def store_document(db: Session, doc: schemas.DocumentCreate, realtor_id: int, upload_path: str):
+    """Сохраняет документ, переиспользуя blob, если такое содержимое уже загружено.
+
+    doc.filepath должен указывать на storage.blob_path(..., doc.checksum).
+    """
+    try:
+        # Файл кладем на место, пока держим блокировку строки blob-а, чтобы
+        # параллельное удаление последней ссылки не убрало его из-под нас
+        _acquire_blob(db, doc.checksum, doc.size)
+        storage.place_blob(upload_path, doc.filepath)
+        return create_document(db, doc, realtor_id)
+    except Exception:
+        db.rollback()
+        raise
+
+
 def get_document(db: Session, doc_id: int, agency_id: int):
     return db.query(models.Document).filter(
         models.Document.id == doc_id,
@@ -228,77 +1046,113 @@ def delete_document(db: Session, doc_id: int, agency_id: int):
     doc = get_document(db, doc_id, agency_id)
     if not doc:
         return False
-    try:
-        # Удаляем физический файл
-        shutil.rmtree(doc.filepath, ignore_errors=True) # Используем rmtree, чтобы удалить папку, если она пуста
-        if os.path.exists(doc.filepath):
-             os.remove(doc.filepath)
-    except OSError as e:
-        print(f"Error deleting file {doc.filepath}: {e}")
-
     db.delete(doc)
-    db.commit()
+    reclaim = doc.checksum is None or _release_blob(db, doc.checksum)
+    # Файл убираем до коммита (под блокировкой blob-а), но так, чтобы его
+    # можно было вернуть, если транзакция не зафиксируется
+    trash_path = storage.detach_blob(doc.filepath) if reclaim else None
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        if trash_path:
+            storage.restore_blob(trash_path, doc.filepath)
+        raise
+    if trash_path:
+        storage.discard(trash_path)
     return True
 
 
-def get_realtor_stats(db: Session, realtor_id: int):
-    realtor = db.query(models.Realtor).filter(models.Realtor.id == realtor_id).first()
-    if not realtor:
-        return None
-
-    properties_for_sale = db.query(models.Property).filter(
-        models.Property.realtor_id == realtor_id,
-        models.Property.status == 'for_sale'
-    ).count()
-
-    properties_sold = db.query(models.Property).filter(
-        models.Property.realtor_id == realtor_id,
-        models.Property.status == 'sold'
-    ).count()
+def _realtor_stats_query(db: Session):
+    # Показатели читаются из сводки (rollups.py): O(1) на риэлтора вне
+    # зависимости от размера его портфеля
+    return (
+        db.query(
+            models.Realtor.id,
+            models.Realtor.full_name,
+            func.coalesce(models.StatsRollup.for_sale_count, 0).label("properties_for_sale"),
+            func.coalesce(models.StatsRollup.sold_count, 0).label("properties_sold"),
+            func.coalesce(models.StatsRollup.total_sales_value, 0).label("total_sales_value"),
+        )
+        .outerjoin(models.StatsRollup, and_(
+            models.StatsRollup.scope == rollups.SCOPE_REALTOR,
+            models.StatsRollup.scope_id == models.Realtor.id,
+        ))
+    )
 
-    total_sales_value = db.query(func.sum(models.Property.price)).filter(
-        models.Property.realtor_id == realtor_id,
-        models.Property.status == 'sold'
-    ).scalar() or 0
 
+def _realtor_stats_from_row(row):
     return schemas.RealtorStats(
-        realtor_id=realtor_id,
-        full_name=realtor.full_name,
-        properties_for_sale=properties_for_sale,
-        properties_sold=properties_sold,
-        total_sales_value=total_sales_value
+        realtor_id=row.id,
+        full_name=row.full_name,
+        properties_for_sale=row.properties_for_sale,
+        properties_sold=row.properties_sold,
+        total_sales_value=row.total_sales_value,
     )
 
 
-def get_agency_stats(db: Session, agency_id: int):
-    agency = db.query(models.Agency).filter(models.Agency.id == agency_id).first()
-    if not agency:
+def get_realtor_stats(db: Session, realtor_id: int):
+    row = _realtor_stats_query(db).filter(models.Realtor.id == realtor_id).first()
+    if not row:
         return None
+    return _realtor_stats_from_row(row)
 
-    total_realtors = db.query(models.Realtor).filter(models.Realtor.agency_id == agency_id).count()
 
-    properties_for_sale = db.query(models.Property).filter(
-        models.Property.agency_id == agency_id,
-        models.Property.status == 'for_sale'
-    ).count()
+def get_agency_leaderboard(db: Session, agency_id: int, limit: int = 100):
+    """Показатели всех риэлторов агентства одним запросом, лучшие по продажам первыми."""
+    rows = (
+        _realtor_stats_query(db)
+        .filter(models.Realtor.agency_id == agency_id)
+        .order_by(desc("total_sales_value"), models.Realtor.id)
+        .limit(limit)
+        .all()
+    )
+    return [_realtor_stats_from_row(row) for row in rows]
 
-    properties_sold = db.query(models.Property).filter(
-        models.Property.agency_id == agency_id,
-        models.Property.status == 'sold'
-    ).count()
 
-    total_sales_value = db.query(func.sum(models.Property.price)).filter(
-        models.Property.agency_id == agency_id,
-        models.Property.status == 'sold'
-    ).scalar() or 0
+def get_agency_stats(db: Session, agency_id: int):
+    total_realtors = (
+        select(func.count(models.Realtor.id))
+        .where(models.Realtor.agency_id == models.Agency.id)
+        .correlate(models.Agency)
+        .scalar_subquery()
+    )
+    row = (
+        db.query(
+            models.Agency.id,
+            models.Agency.name,
+            total_realtors.label("total_realtors"),
+            func.coalesce(models.StatsRollup.for_sale_count, 0).label("properties_for_sale"),
+            func.coalesce(models.StatsRollup.sold_count, 0).label("properties_sold"),
+            func.coalesce(models.StatsRollup.total_sales_value, 0).label("total_sales_value"),
+        )
+        .outerjoin(models.StatsRollup, and_(
+            models.StatsRollup.scope == rollups.SCOPE_AGENCY,
+            models.StatsRollup.scope_id == models.Agency.id,
+        ))
+        .filter(models.Agency.id == agency_id)
+        .first()
+    )
+    if not row:
+        return None
 
     return schemas.AgencyStats(
-        agency_id=agency_id,
-        name=agency.name,
-        total_realtors=total_realtors,
-        properties_for_sale=properties_for_sale,
-        properties_sold=properties_sold,
-        total_sales_value=total_sales_value
+        agency_id=row.id,
+        name=row.name,
+        total_realtors=row.total_realtors,
+        properties_for_sale=row.properties_for_sale,
+        properties_sold=row.properties_sold,
+        total_sales_value=row.total_sales_value
+    )
+
+
+def get_monthly_sales(db: Session, scope: str, scope_id: int, months: int = 12):
+    return (
+        db.query(models.MonthlySalesRollup)
+        .filter(models.MonthlySalesRollup.scope == scope, models.MonthlySalesRollup.scope_id == scope_id)
+        .order_by(models.MonthlySalesRollup.month.desc())
+        .limit(months)
+        .all()
     )
 
 
@@ -306,6 +1160,7 @@ def get_agency_stats(db: Session, agency_id: int):
 def create_training_event(db: Session, event: schemas.TrainingEventCreate):
     db_event = models.TrainingEvent(**event.dict())
     db.add(db_event)
+    _training_events_changed(db)
     db.commit()
     db.refresh(db_event)
     return db_event
@@ -313,29 +1168,259 @@ def create_training_event(db: Session, event: schemas.TrainingEventCreate):
 def get_training_events(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.TrainingEvent).order_by(models.TrainingEvent.start_time).offset(skip).limit(limit).all()
 
+def get_training_events_cached(db: Session, version: versions.Version, skip: int = 0, limit: int = 100):
+    def load():
+        return [_dump(schemas.TrainingEvent, e) for e in get_training_events(db, skip=skip, limit=limit)]
+
+    return response_cache.cache.get_or_load(
+        "events", (version.version, skip, limit), [response_cache.tag(response_cache.TAG_EVENTS)], load
+    )
+
 def get_training_event(db: Session, event_id: int):
     return db.query(models.TrainingEvent).filter(models.TrainingEvent.id == event_id).first()
 
+def _lock_training_event(db: Session, event_id: int):
+    # Все изменения мест события идут под блокировкой его строки: регистрация
+    # и отмена одного события выполняются строго по очереди
+    return _lock_row(db, models.TrainingEvent, event_id)
+
+
 def register_for_event(db: Session, event_id: int, realtor_id: int):
-    # Проверяем, что риэлтор еще не зарегистрирован
-    existing_registration = db.query(models.EventRegistration).filter(
-        models.EventRegistration.event_id == event_id,
-        models.EventRegistration.realtor_id == realtor_id
-    ).first()
-    if existing_registration:
-        return None # Уже зарегистрирован
+    """Регистрирует риэлтора на событие: место, если есть, иначе лист ожидания.
+
+    Повторная регистрация возвращает существующую запись. None - события нет.
+    """
+    Registration = models.EventRegistration
+    # Сначала блокировка события: заодно проверяем, что оно есть, до вставки,
+    # которая на несуществующем событии упала бы на внешнем ключе
+    db_event = _lock_training_event(db, event_id)
+    if db_event is None:
+        db.rollback()
+        return None
+    has_seat = db_event.capacity is None or db_event.seats_taken < db_event.capacity
+    status = models.RegistrationStatusEnum.confirmed if has_seat else models.RegistrationStatusEnum.waitlisted
+    # Повторный запрос того же риэлтора упирается в уникальный индекс (event_id, realtor_id)
+    inserted = db.execute(
+        dialect_insert(db)(Registration)
+        .values(event_id=event_id, realtor_id=realtor_id, status=status)
+        .on_conflict_do_nothing(index_elements=[Registration.event_id, Registration.realtor_id])
+        .returning(Registration.id)
+    ).scalar()
+    if inserted is None:
+        db.rollback()
+        return db.query(Registration).filter(
+            Registration.event_id == event_id, Registration.realtor_id == realtor_id
+        ).first()
+    if has_seat:
+        db_event.seats_taken = models.TrainingEvent.seats_taken + 1
+        # В списке событий видно число занятых мест
+        _training_events_changed(db)
+    db.commit()
+    return db.get(Registration, inserted)
+
+
+def cancel_event_registration(db: Session, event_id: int, realtor_id: int):
+    """Отменяет регистрацию; освободившееся место получает первый из листа ожидания.
+
+    Возвращает False, если регистрации не было.
+    """
+    Registration = models.EventRegistration
+    # Порядок блокировок как при регистрации: сначала строка события, потом регистрации
+    db_event = _lock_training_event(db, event_id)
+    cancelled = db.execute(
+        delete(Registration)
+        .where(Registration.event_id == event_id, Registration.realtor_id == realtor_id)
+        .returning(Registration.status)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if cancelled is None:
+        db.rollback()
+        return False
+    if db_event is not None and cancelled == models.RegistrationStatusEnum.confirmed:
+        promoted = db.query(Registration).filter(
+            Registration.event_id == event_id,
+            Registration.status == models.RegistrationStatusEnum.waitlisted,
+        ).order_by(Registration.registered_at, Registration.id).first()
+        if promoted is None:
+            db_event.seats_taken = models.TrainingEvent.seats_taken - 1
+            _training_events_changed(db)
+        else:
+            # Место переходит к следующему в очереди, число занятых не меняется
+            promoted.status = models.RegistrationStatusEnum.confirmed
+            _add_notification(db, promoted.realtor_id, f"Освободилось место на событии '{db_event.title}', вы зарегистрированы")
+    db.commit()
+    return True
 
-    db_registration = models.EventRegistration(event_id=event_id, realtor_id=realtor_id)
-    db.add(db_registration)
+
+def get_registrations_for_event(db: Session, event_id: int, status: str | None = None):
+    query = db.query(models.EventRegistration).filter(models.EventRegistration.event_id == event_id)
+    if status is not None:
+        query = query.filter(models.EventRegistration.status == status)
+    return query.order_by(models.EventRegistration.registered_at, models.EventRegistration.id).all()
+
+
+def _store_rehashed_password(db: Session, realtor: models.Realtor, new_hash: str):
+    realtor.hashed_password = new_hash
     db.commit()
-    db.refresh(db_registration)
-    return db_registration
+    db.refresh(realtor)
 
-def get_registrations_for_event(db: Session, event_id: int):
-    return db.query(models.EventRegistration).filter(models.EventRegistration.event_id == event_id).all()
 
 def authenticate_realtor(db: Session, email: str, password: str):
     realtor = get_realtor_by_email(db, email=email)
-    if not realtor or not verify_password(password, realtor.hashed_password):
+    if not realtor:
         return None
-    return realtor
\ No newline at end of file
+    verified, new_hash = passwords.verify_and_update(password, realtor.hashed_password)
+    if not verified:
+        return None
+    if new_hash:
+        _store_rehashed_password(db, realtor, new_hash)
+    return realtor
+
+
+async def authenticate_realtor_async(db: AsyncSession, email: str, password: str):
+    realtor = await get_realtor_by_email_async(db, email)
+    if not realtor:
+        return None
+    verified, new_hash = await passwords.verify_and_update_async(password, realtor.hashed_password)
+    if not verified:
+        return None
+    # Параметры pwd_context поменялись - сохраняем хэш с новой стоимостью
+    if new_hash:
+        await db.run_sync(_store_rehashed_password, realtor, new_hash)
+    return realtor
+
+
+# Async-версии горячих функций для эндпоинтов на AsyncSession. Запросы те же:
+# run_sync выполняет синхронную функцию в greenlet поверх асинхронного
+# соединения, так что ввод-вывод идет через event loop без потоков из пула.
+# Возвращаемые объекты должны быть полностью загружены: ленивая подгрузка
+# связей вне run_sync невозможна.
+async def get_realtor_by_email_async(db: AsyncSession, email: str):
+    return await db.run_sync(get_realtor_by_email, email)
+
+
+async def get_realtor_async(db: AsyncSession, realtor_id: int):
+    return await db.get(models.Realtor, realtor_id)
+
+
+# Чтения для эндпоинтов идут через кэш (response_cache.py) и возвращают
+# JSON-совместимые данные (тело ответа), а не объекты сессии. Ключ включает
+# версию набора данных из change_counters: сброс тегов виден только
+# записавшему процессу, а счетчик в БД - всем, поэтому другой воркер не
+# отдаст старое тело (и под новым ETag). Версия читается до данных, так что
+# тело под ключом версии может быть только новее нее
+
+
+def _dump(schema, obj):
+    return schema.model_validate(obj).model_dump(mode="json")
+
+
+async def get_property_async(db: AsyncSession, property_id: int, version: versions.Version):
+    async def load():
+        db_property = await db.run_sync(get_property, property_id)
+        return _dump(schemas.Property, db_property) if db_property else None
+
+    return await response_cache.cache.get_or_load_async(
+        "property", (property_id, version.version), [response_cache.tag(response_cache.TAG_PROPERTY, property_id)], load
+    )
+
+
+async def get_properties_async(db: AsyncSession, version: versions.Version, **filters):
+    agency_id = filters.get("agency_id")
+    if agency_id is not None:
+        tags = [response_cache.tag(response_cache.TAG_AGENCY_PROPERTIES, agency_id)]
+    else:
+        tags = [response_cache.tag(response_cache.TAG_ALL_PROPERTIES)]
+
+    async def load():
+        rows, next_cursor = await db.run_sync(get_properties, **filters)
+        return [_dump(schemas.Property, row) for row in rows], next_cursor
+
+    return await response_cache.cache.get_or_load_async(
+        "properties", (version.version, sorted(filters.items())), tags, load
+    )
+
+
+async def get_property_version_async(db: AsyncSession, property_id: int):
+    return await db.run_sync(get_property_version, property_id)
+
+
+async def get_properties_version_async(db: AsyncSession, agency_id: int | None = None):
+    return await db.run_sync(get_properties_version, agency_id)
+
+
+async def get_notifications_async(db: AsyncSession, realtor_id: int, **filters):
+    return await db.run_sync(get_notifications, realtor_id, **filters)
+
+
+async def count_unread_notifications_async(db: AsyncSession, realtor_id: int):
+    return await db.run_sync(count_unread_notifications, realtor_id)
+
+
+async def mark_notifications_read_async(db: AsyncSession, realtor_id: int, notification_ids: list[int] | None = None):
+    return await db.run_sync(mark_notifications_read, realtor_id, notification_ids)
+
+
+async def mark_notification_read_async(db: AsyncSession, notification_id: int, realtor_id: int):
+    return await db.run_sync(mark_notification_read, notification_id, realtor_id)
+
+
+async def _cached_calendar(db: AsyncSession, name: str, scope: str, scope_id: int, args, read):
+    version = await db.run_sync(versions.current, scope, scope_id)
+
+    async def load():
+        return [_dump(schemas.CalendarEvent, event) for event in await db.run_sync(read)]
+
+    tag_kind = response_cache.TAG_CALENDAR if scope == versions.SCOPE_CALENDAR else response_cache.TAG_AGENCY_CALENDAR
+    return await response_cache.cache.get_or_load_async(
+        name, (version.version, args), [response_cache.tag(tag_kind, scope_id)], load
+    )
+
+
+async def get_calendar_events_async(db: AsyncSession, realtor_id: int, skip: int = 0, limit: int = 100):
+    return await _cached_calendar(
+        db, "calendar", versions.SCOPE_CALENDAR, realtor_id, (skip, limit),
+        lambda session: get_calendar_events(session, realtor_id, skip=skip, limit=limit),
+    )
+
+
+async def get_calendar_events_in_range_async(db: AsyncSession, realtor_id: int, start: datetime, end: datetime):
+    return await _cached_calendar(
+        db, "calendar_range", versions.SCOPE_CALENDAR, realtor_id, (start, end),
+        lambda session: get_calendar_events_in_range(session, realtor_id, start, end),
+    )
+
+
+async def get_agency_calendar_events_async(db: AsyncSession, agency_id: int, start: datetime, end: datetime):
+    return await _cached_calendar(
+        db, "agency_calendar", versions.SCOPE_AGENCY_CALENDAR, agency_id, (start, end),
+        lambda session: get_agency_calendar_events(session, agency_id, start, end),
+    )
+
+
+async def find_free_slots_async(db: AsyncSession, start: datetime, end: datetime, min_duration: timedelta, **scope):
+    return await db.run_sync(find_free_slots, start, end, min_duration, **scope)
+
+
+async def create_calendar_event_async(db: AsyncSession, event: schemas.CalendarEventCreate, realtor_id: int):
+    return await db.run_sync(create_calendar_event, event, realtor_id)
+
+
+async def update_calendar_event_async(
+    db: AsyncSession, event_id: int, event_update: schemas.CalendarEventCreate, realtor_id: int
+):
+    return await db.run_sync(update_calendar_event, event_id, event_update, realtor_id)
+
+
+async def delete_calendar_event_async(db: AsyncSession, event_id: int, realtor_id: int):
+    return await db.run_sync(delete_calendar_event, event_id, realtor_id)
+
+
+async def set_calendar_event_exception_async(
+    db: AsyncSession, event_id: int, exception: schemas.CalendarEventExceptionCreate, realtor_id: int
+):
+    return await db.run_sync(set_calendar_event_exception, event_id, exception, realtor_id)
+
+
+async def delete_calendar_event_exception_async(db: AsyncSession, event_id: int, exception_id: int, realtor_id: int):
+    return await db.run_sync(delete_calendar_event_exception, event_id, exception_id, realtor_id)
@@ -0,0 +1,108 @@
+import math
+
+# Геохэш: чередуем биты долготы и широты, кодируем по 5 бит в символ base32.
+# Префикс геохэша задает прямоугольную ячейку, поэтому обычный B-tree индекс
+# по строке отвечает на запрос "все точки в ячейке" как на диапазон ключей.
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+# Символ, идущий в ASCII сразу после последнего символа алфавита: все
+# геохэши с префиксом p лежат в полуинтервале [p, p + _UPPER_BOUND).
+_UPPER_BOUND = "{"
+
+GEOHASH_PRECISION = 9  # ~5 x 5 м, с запасом для любых запросов по карте
+MAX_COVER_CELLS = 32  # Сколько ячеек допускаем в покрытии одной области
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bit, ch, even = 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            ch = (ch << 1) | 1
+            rng[0] = mid
+        else:
+            ch <<= 1
+            rng[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(_BASE32[ch])
+            bit, ch = 0, 0
+    return "".join(chars)
+
+
+def cell_size(precision: int):
+    """Размер ячейки (градусы широты, градусы долготы) для заданной точности."""
+    bits = 5 * precision
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def _cover_box(min_lat, min_lon, max_lat, max_lon):
+    # Ищем самую мелкую точность, при которой область покрывается не более
+    # чем MAX_COVER_CELLS ячейками: мельче ячейки - меньше лишних строк.
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        cell_lat, cell_lon = cell_size(precision)
+        i0 = math.floor((min_lat + 90) / cell_lat)
+        i1 = math.floor((min(max_lat, 90 - 1e-9) + 90) / cell_lat)
+        j0 = math.floor((min_lon + 180) / cell_lon)
+        j1 = math.floor((min(max_lon, 180 - 1e-9) + 180) / cell_lon)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) <= MAX_COVER_CELLS:
+            break
+    cells = set()
+    for i in range(i0, i1 + 1):
+        for j in range(j0, j1 + 1):
+            center_lat = -90 + (i + 0.5) * cell_lat
+            center_lon = -180 + (j + 0.5) * cell_lon
+            cells.add(encode(center_lat, center_lon, precision))
+    return cells
+
+
+def split_bbox(min_lat, min_lon, max_lat, max_lon):
+    """Разбивает область, пересекающую 180-й меридиан, на две обычные."""
+    min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+    if max_lon - min_lon >= 360:
+        return [(min_lat, -180.0, max_lat, 180.0)]
+    min_lon = (min_lon + 180) % 360 - 180
+    max_lon = (max_lon + 180) % 360 - 180
+    if min_lon <= max_lon:
+        return [(min_lat, min_lon, max_lat, max_lon)]
+    return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)]
+
+
+def cover(boxes):
+    """Набор префиксов геохэша, покрывающих все переданные области."""
+    cells = set()
+    for box in boxes:
+        cells |= _cover_box(*box)
+    # Если одна ячейка - префикс другой, мелкая уже покрыта крупной
+    return sorted(c for c in cells if not any(c != p and c.startswith(p) for p in cells))
+
+
+def prefix_range(prefix: str):
+    return prefix, prefix + _UPPER_BOUND
+
+
+def radius_bbox(latitude: float, longitude: float, radius_km: float):
+    angular = radius_km / EARTH_RADIUS_KM
+    d_lat = math.degrees(angular)
+    cos_lat = math.cos(math.radians(latitude))
+    if abs(latitude) + d_lat >= 90 or math.sin(angular) >= cos_lat:
+        # Окружность захватывает полюс - берем всю полосу широт
+        return split_bbox(latitude - d_lat, -180.0, latitude + d_lat, 180.0)
+    d_lon = math.degrees(math.asin(math.sin(angular) / cos_lat))
+    return split_bbox(latitude - d_lat, longitude - d_lon, latitude + d_lat, longitude + d_lon)
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
@@ -0,0 +1,63 @@
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response, status
+
+from .versions import Version
+
+# Условные GET: ETag строится из версии данных (versions.py) и самого URL с
+# параметрами, поэтому у каждой страницы и фильтра свой тег. Если клиент или
+# прокси прислал актуальный тег, отвечаем 304 до выборки и сериализации.
+
+# Меняется вместе с форматом ответов, чтобы после обновления API клиенты не
+# получали 304 на закэшированное тело старого формата
+REPRESENTATION_VERSION = 1
+
+# Ответы с авторизацией кэширует только клиент; общие - и прокси. В обоих
+# случаях no-cache: копию можно хранить, но перед выдачей ее надо подтвердить
+# условным запросом, так что устаревшие данные не отдаются
+PRIVATE_CACHE_CONTROL = "private, no-cache"
+PUBLIC_CACHE_CONTROL = "public, no-cache"
+
+
+def etag(request: Request, version: Version) -> str:
+    key = f"{REPRESENTATION_VERSION}:{version.version}:{request.url.path}?{request.url.query}"
+    return '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+
+
+def _etag_matches(header: str, current: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # Сравнение для If-None-Match слабое: префикс W/ не мешает совпадению
+    tags = (tag.strip() for tag in header.split(","))
+    return current in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def is_fresh(request: Request, current_etag: str, version: Version) -> bool:
+    """Есть ли у клиента актуальная копия (RFC 9110, 13.2.2)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # При наличии If-None-Match дата не учитывается
+        return _etag_matches(if_none_match, current_etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or version.changed_at is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    # Last-Modified передается с точностью до секунды
+    return version.changed_at.replace(microsecond=0) <= since
+
+
+def headers(current_etag: str, version: Version, cache_control: str = PRIVATE_CACHE_CONTROL) -> dict:
+    result = {"ETag": current_etag, "Cache-Control": cache_control}
+    if version.changed_at is not None:
+        result["Last-Modified"] = format_datetime(version.changed_at, usegmt=True)
+    return result
+
+
+def not_modified(current_etag: str, version: Version, cache_control: str = PRIVATE_CACHE_CONTROL) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers(current_etag, version, cache_control))
@@ -1,16 +1,20 @@
-from fastapi import Depends, FastAPI, HTTPException, status, Query, UploadFile, File
+from fastapi import Depends, FastAPI, HTTPException, status, Query, UploadFile, File, Request, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional, List
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 import os
-import uuid
 
-from . import crud, models, schemas
-from .database import SessionLocal, engine
+from . import (
+    bulk, crud, http_cache, metrics, migrations, models, passwords, pubsub, replicas, response_cache, rollups,
+    schemas, search, storage,
+)
+from .cache import principal_cache
+from .database import AsyncSessionLocal, SessionLocal, async_engine, engine
 
 # --- Constants and Setup ---
 SECRET_KEY = "your_secret_key_here" # В реальном проекте это нужно вынести в переменные окружения
@@ -18,9 +22,15 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 UPLOADS_DIR = "uploads"
 
-models.Base.metadata.create_all(bind=engine)
+# Схема создается и обновляется отдельной командой: python migrate.py
 app = FastAPI(title="RealtyPro API")
 
+metrics.instrument_engine(engine, "primary")
+metrics.instrument_engine(async_engine.sync_engine, "primary")
+for number, replica in enumerate(replicas.router.replicas):
+    metrics.instrument_engine(replica.engine, f"replica{number}")
+    metrics.instrument_engine(replica.async_engine.sync_engine, f"replica{number}")
+
 # --- CORS Middleware ---
 # Это разрешит вашему frontend-приложению (с localhost:3000)
 # делать запросы к backend-серверу.
@@ -35,18 +45,89 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"], # Разрешаем все методы (GET, POST, и т.д.)
     allow_headers=["*"], # Разрешаем все заголовки
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified"], # Курсор следующей страницы списков и валидаторы кэша
 )
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+@app.exception_handler(passwords.PasswordPoolBusy)
+def password_pool_busy_handler(request, exc):
+    # Очередь bcrypt переполнена: просим клиента повторить позже, а не держим соединение
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Authentication service is busy, please retry"},
+        headers={"Retry-After": "1"},
+    )
+
+@app.on_event("shutdown")
+def shutdown_password_pool():
+    passwords.pool.shutdown()
+
+@app.on_event("shutdown")
+async def dispose_async_engine():
+    await async_engine.dispose()
+
+@app.on_event("startup")
+def check_schema_version():
+    # Один SELECT вместо DDL при старте каждого воркера
+    pending = migrations.pending(engine)
+    if pending:
+        names = ", ".join(f"{version:04d}_{name}" for version, name in pending)
+        raise RuntimeError(f"Database schema is out of date ({names}), run: python migrate.py")
+
+@app.on_event("startup")
+def start_replica_health_checks():
+    replicas.router.start()
+
+@app.on_event("shutdown")
+async def shutdown_replicas():
+    await replicas.router.shutdown()
+
+@app.on_event("startup")
+def start_notification_hub():
+    pubsub.hub.start()
+
+@app.on_event("shutdown")
+def stop_notification_hub():
+    pubsub.hub.stop()
+
+@app.middleware("http")
+async def remember_writers(request: Request, call_next):
+    response = await call_next(request)
+    # После успешной записи клиент какое-то время читает с основной БД,
+    # чтобы сразу видеть свои изменения несмотря на отставание реплик
+    if request.method not in replicas.SAFE_METHODS and response.status_code < 400:
+        replicas.router.note_write(request)
+    return response
+
+# Лимит размера загрузки до того, как Starlette примет и разберет тело
+app.add_middleware(storage.UploadLimitMiddleware, paths={"/documents/upload"})
+
+# Добавлен последним - значит, самый внешний: время считается с учетом всех middleware
+app.add_middleware(metrics.MetricsMiddleware)
+
 # --- Dependencies ---
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    replica = replicas.router.route(request)
+    if replica is None:
+        db = SessionLocal()
+    else:
+        db = SessionLocal(bind=replica.engine, info={"replica": True})
     try:
         yield db
     finally:
         db.close()
 
+async def get_async_db(request: Request):
+    # Для async-эндпоинтов: ожидание БД не занимает поток
+    replica = replicas.router.route(request)
+    if replica is None:
+        session = AsyncSessionLocal()
+    else:
+        session = AsyncSessionLocal(bind=replica.async_engine, info={"replica": True})
+    async with session as db:
+        yield db
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -57,7 +138,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_realtor(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_realtor(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> schemas.Realtor:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -68,26 +149,43 @@ def get_current_realtor(token: str = Depends(oauth2_scheme), db: Session = Depen
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
-        token_data = schemas.TokenData(email=email)
-    except JWTError:
+        token_data = schemas.TokenData(
+            email=email,
+            realtor_id=payload.get("uid"),
+            agency_id=payload.get("agency_id"),
+            role=payload.get("role"),
+        )
+    except (JWTError, ValueError):
         raise credentials_exception
-    realtor = crud.get_realtor_by_email(db, email=token_data.email)
+    # Профиль берем из кэша; в БД идем только при промахе
+    realtor = principal_cache.get(token_data.email)
     if realtor is None:
+        db_realtor = await crud.get_realtor_by_email_async(db, token_data.email)
+        if db_realtor is None:
+            raise credentials_exception
+        realtor = schemas.Realtor.model_validate(db_realtor)
+        principal_cache.set(token_data.email, realtor)
+    # Токен, выданный до смены роли или агентства, больше не действителен
+    if token_data.realtor_id is not None and (
+        token_data.realtor_id != realtor.id
+        or token_data.agency_id != realtor.agency_id
+        or token_data.role != realtor.role
+    ):
         raise credentials_exception
     return realtor
 
 # --- Role-based Dependencies ---
-def get_current_active_realtor(current_user: models.Realtor = Depends(get_current_realtor)) -> models.Realtor:
+async def get_current_active_realtor(current_user: schemas.Realtor = Depends(get_current_realtor)) -> schemas.Realtor:
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
-def get_current_active_manager(current_user: models.Realtor = Depends(get_current_active_realtor)) -> models.Realtor:
+async def get_current_active_manager(current_user: schemas.Realtor = Depends(get_current_active_realtor)) -> schemas.Realtor:
     if current_user.role not in [models.RealtorRoleEnum.manager, models.RealtorRoleEnum.admin]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Requires manager or admin role")
     return current_user
 
-def get_current_active_admin(current_user: models.Realtor = Depends(get_current_active_realtor)) -> models.Realtor:
+async def get_current_active_admin(current_user: schemas.Realtor = Depends(get_current_active_realtor)) -> schemas.Realtor:
     if current_user.role != models.RealtorRoleEnum.admin:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Requires admin role")
     return current_user
@@ -100,8 +198,8 @@ def read_root():
 
 # Auth
 @app.post("/token", response_model=schemas.Token, tags=["Auth"])
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    realtor = crud.authenticate_realtor(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    realtor = await crud.authenticate_realtor_async(db, form_data.username, form_data.password)
     if not realtor:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -109,7 +207,15 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
             headers={"WWW-Authenticate": "Bearer"},
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": realtor.email}, expires_delta=access_token_expires)
+    access_token = create_access_token(
+        data={
+            "sub": realtor.email,
+            "uid": realtor.id,
+            "agency_id": realtor.agency_id,
+            "role": realtor.role.value,
+        },
+        expires_delta=access_token_expires,
+    )
     return {"access_token": access_token, "token_type": "bearer"}
 
 # Users & Agencies
@@ -121,85 +227,512 @@ def create_agency(agency: schemas.AgencyCreate, db: Session = Depends(get_db)):
     return crud.create_agency(db=db, agency=agency)
 
 @app.post("/realtors/", response_model=schemas.Realtor, tags=["Users & Agencies"])
-def create_realtor(realtor: schemas.RealtorCreate, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_manager)):
-    if crud.get_realtor_by_email(db, email=realtor.email):
+async def create_realtor(realtor: schemas.RealtorCreate, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_manager)):
+    if await crud.get_realtor_by_email_async(db, realtor.email):
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_realtor(db=db, realtor=realtor, agency_id=current_user.agency_id)
+    return await crud.create_realtor_async(db=db, realtor=realtor, agency_id=current_user.agency_id)
+
+@app.patch("/realtors/{realtor_id}/access", response_model=schemas.Realtor, tags=["Users & Agencies"])
+def update_realtor_access(realtor_id: int, access: schemas.RealtorAccessUpdate, db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_admin)):
+    db_realtor = crud.update_realtor_access(db, realtor_id, access)
+    if not db_realtor:
+        raise HTTPException(status_code=404, detail="Realtor not found")
+    return db_realtor
 
 @app.get("/users/me", response_model=schemas.Realtor, tags=["Users & Agencies"])
-def read_users_me(current_user: models.Realtor = Depends(get_current_active_realtor)):
+def read_users_me(current_user: schemas.Realtor = Depends(get_current_active_realtor)):
     return current_user
 
 # Properties
 @app.post("/properties/", response_model=schemas.Property, tags=["Properties"])
-def create_property(property: schemas.PropertyCreate, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
+def create_property(property: schemas.PropertyCreate, db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
     return crud.create_property(db=db, property=property, agency_id=current_user.agency_id, realtor_id=current_user.id)
 
 @app.get("/properties/", response_model=List[schemas.Property], tags=["Properties"])
-def read_properties(skip: int = 0, limit: int = Query(100, le=100), db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
-    properties = crud.get_properties(db, skip=skip, limit=limit)
+async def read_properties(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=100),
+    sort: schemas.PropertySortKey = schemas.PropertySortKey.created_at,
+    order: schemas.SortOrder = schemas.SortOrder.desc,
+    status: Optional[schemas.PropertyStatusEnum] = None,
+    min_price: Optional[int] = Query(None, ge=0),
+    max_price: Optional[int] = Query(None, ge=0),
+    agency_id: Optional[int] = None,
+    realtor_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    version = await crud.get_properties_version_async(db, agency_id)
+    etag = http_cache.etag(request, version)
+    if http_cache.is_fresh(request, etag, version):
+        return http_cache.not_modified(etag, version)
+    try:
+        properties, next_cursor = await crud.get_properties_async(
+            db,
+            version,
+            limit=limit,
+            cursor=cursor,
+            sort=sort.value,
+            descending=order == schemas.SortOrder.desc,
+            status=status.value if status else None,
+            min_price=min_price,
+            max_price=max_price,
+            agency_id=agency_id,
+            realtor_id=realtor_id,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    response.headers.update(http_cache.headers(etag, version))
     return properties
 
+@app.post("/properties/bulk", response_model=schemas.BulkImportResult, tags=["Properties"])
+def bulk_import_properties(
+    file: UploadFile = File(...),
+    format: Optional[schemas.BulkFormat] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    fmt = format.value if format else bulk.detect_format(file.filename, file.content_type)
+    if fmt is None:
+        raise HTTPException(status_code=400, detail="Cannot detect file format, pass format=csv or format=ndjson")
+    return bulk.import_properties(db, file.file, fmt, agency_id=current_user.agency_id, realtor_id=current_user.id)
+
+@app.get("/properties/export", tags=["Properties"])
+def bulk_export_properties(
+    format: schemas.BulkFormat = schemas.BulkFormat.csv,
+    status: Optional[schemas.PropertyStatusEnum] = None,
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    def stream():
+        # Своя сессия: ответ отдается уже после выхода из зависимостей запроса
+        db = SessionLocal()
+        try:
+            yield from bulk.export_properties(
+                db, format.value, agency_id=current_user.agency_id, status=status.value if status else None
+            )
+        finally:
+            db.close()
+
+    return StreamingResponse(
+        stream(),
+        media_type=bulk.MEDIA_TYPES[format.value],
+        headers={"Content-Disposition": f'attachment; filename="properties.{format.value}"'},
+    )
+
+@app.get("/properties/search", response_model=List[schemas.Property], tags=["Properties"])
+def search_properties_endpoint(
+    q: str = Query(..., min_length=1, max_length=200),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    status: Optional[schemas.PropertyStatusEnum] = None,
+    agency_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    return search.search_properties(
+        db, q, limit=limit, skip=skip,
+        agency_id=agency_id, status=status.value if status else None,
+    )
+
+@app.get("/properties/near", response_model=List[schemas.PropertyWithDistance], tags=["Properties"])
+def read_properties_near(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(..., gt=0, le=500),
+    limit: int = Query(100, ge=1, le=100),
+    status: Optional[schemas.PropertyStatusEnum] = None,
+    agency_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    results = crud.get_properties_near(
+        db, lat, lon, radius_km, limit=limit,
+        agency_id=agency_id, status=status.value if status else None,
+    )
+    return [
+        schemas.PropertyWithDistance(**schemas.Property.model_validate(p).model_dump(), distance_km=round(d, 3))
+        for p, d in results
+    ]
+
+@app.get("/properties/bbox", response_model=List[schemas.Property], tags=["Properties"])
+def read_properties_in_bbox(
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    limit: int = Query(100, ge=1, le=100),
+    status: Optional[schemas.PropertyStatusEnum] = None,
+    agency_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    if min_lat > max_lat:
+        raise HTTPException(status_code=400, detail="min_lat must not exceed max_lat")
+    return crud.get_properties_in_bbox(
+        db, min_lat, min_lon, max_lat, max_lon, limit=limit,
+        agency_id=agency_id, status=status.value if status else None,
+    )
+
 @app.get("/properties/{property_id}", response_model=schemas.Property, tags=["Properties"])
-def read_property(property_id: int, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
-    db_property = crud.get_property(db, property_id)
+async def read_property(property_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    # Версию читаем до данных: данные могут оказаться только новее тега, но не старше
+    version = await crud.get_property_version_async(db, property_id)
+    etag = http_cache.etag(request, version)
+    if http_cache.is_fresh(request, etag, version):
+        return http_cache.not_modified(etag, version)
+    db_property = await crud.get_property_async(db, property_id, version)
     if not db_property:
         raise HTTPException(status_code=404, detail="Property not found")
+    response.headers.update(http_cache.headers(etag, version))
     return db_property
 
 @app.patch("/properties/{property_id}", response_model=schemas.Property, tags=["Properties"])
-def update_property_endpoint(property_id: int, property_update: schemas.PropertyUpdate, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
+def update_property_endpoint(property_id: int, property_update: schemas.PropertyUpdate, db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
     db_property = crud.update_property(db, property_id, property_update, current_user.id)
     if not db_property:
         raise HTTPException(status_code=404, detail="Property not found")
     return db_property
 
 @app.get("/properties/{property_id}/history", response_model=List[schemas.PropertyHistory], tags=["Properties"])
-def property_history(property_id: int, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
+def property_history(property_id: int, request: Request, response: Response, db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    version = crud.get_property_version(db, property_id)
+    etag = http_cache.etag(request, version)
+    if http_cache.is_fresh(request, etag, version):
+        return http_cache.not_modified(etag, version)
+    response.headers.update(http_cache.headers(etag, version))
     return crud.get_property_history(db, property_id)
 
 # Notifications
 @app.get("/notifications/", response_model=List[schemas.Notification], tags=["Notifications"])
-def get_my_notifications(unread_only: bool = False, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
-    return crud.get_notifications(db, realtor_id=current_user.id, unread_only=unread_only)
+async def get_my_notifications(
+    response: Response,
+    unread_only: bool = False,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    try:
+        notifications, next_cursor = await crud.get_notifications_async(
+            db, current_user.id, unread_only=unread_only, limit=limit, cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return notifications
+
+@app.get("/notifications/unread-count", response_model=schemas.NotificationUnreadCount, tags=["Notifications"])
+async def get_my_unread_count(db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    return {"unread": await crud.count_unread_notifications_async(db, current_user.id)}
+
+@app.post("/notifications/read", response_model=schemas.NotificationsMarkReadResult, tags=["Notifications"])
+async def mark_my_notifications_read(body: schemas.NotificationsMarkRead, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    updated = await crud.mark_notifications_read_async(db, current_user.id, body.ids)
+    return {"updated": updated, "unread": await crud.count_unread_notifications_async(db, current_user.id)}
+
+@app.get("/notifications/stream", tags=["Notifications"])
+async def stream_my_notifications(db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    # Соединение с БД, взятое для проверки токена, не держим на все время потока
+    await db.close()
+    subscription = pubsub.hub.subscribe(current_user.id)
+
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                payload = await subscription.get(timeout=pubsub.NOTIFY_HEARTBEAT_SECONDS)
+                if subscription.overflowed:
+                    # Клиент не успевал читать: часть событий потеряна
+                    subscription.overflowed = False
+                    yield pubsub.format_sse({}, event_name="resync")
+                if payload is None:
+                    yield ": ping\n\n"
+                else:
+                    yield pubsub.format_sse(payload)
+        finally:
+            subscription.close()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.post("/notifications/{notification_id}/read", response_model=schemas.Notification, tags=["Notifications"])
-def mark_my_notification_read(notification_id: int, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
-    notification = crud.mark_notification_read(db, notification_id, current_user.id)
+async def mark_my_notification_read(notification_id: int, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    notification = await crud.mark_notification_read_async(db, notification_id, current_user.id)
     if not notification:
         raise HTTPException(status_code=404, detail="Notification not found")
     return notification
 
 # Calendar
-@app.post("/calendar/", response_model=schemas.CalendarEvent, tags=["Calendar"])
-def create_calendar_event_endpoint(event: schemas.CalendarEventCreate, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
-    return crud.create_calendar_event(db, event, current_user.id)
+def _calendar_conflict_response(exc: crud.CalendarConflict):
+    detail = schemas.CalendarConflictDetail(
+        message=str(exc),
+        conflicts=[schemas.CalendarEvent.model_validate(e) for e in exc.conflicts],
+    )
+    return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"detail": detail.model_dump(mode="json")})
+
+@app.post("/calendar/", response_model=schemas.CalendarEvent, tags=["Calendar"], responses={409: {"model": schemas.CalendarConflictDetail}})
+async def create_calendar_event_endpoint(event: schemas.CalendarEventCreate, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    try:
+        return await crud.create_calendar_event_async(db, event, current_user.id)
+    except crud.CalendarConflict as e:
+        return _calendar_conflict_response(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.put("/calendar/{event_id}", response_model=schemas.CalendarEvent, tags=["Calendar"], responses={409: {"model": schemas.CalendarConflictDetail}})
+async def update_calendar_event_endpoint(event_id: int, event: schemas.CalendarEventCreate, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    try:
+        db_event = await crud.update_calendar_event_async(db, event_id, event, current_user.id)
+    except crud.CalendarConflict as e:
+        return _calendar_conflict_response(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not db_event:
+        raise HTTPException(status_code=404, detail="Calendar event not found")
+    return db_event
+
+@app.delete("/calendar/{event_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Calendar"])
+async def delete_calendar_event_endpoint(event_id: int, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    if not await crud.delete_calendar_event_async(db, event_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Calendar event not found")
+
+@app.put("/calendar/{event_id}/exceptions", response_model=schemas.CalendarEventException, tags=["Calendar"], responses={409: {"model": schemas.CalendarConflictDetail}})
+async def set_calendar_event_exception_endpoint(event_id: int, exception: schemas.CalendarEventExceptionCreate, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    try:
+        db_exception = await crud.set_calendar_event_exception_async(db, event_id, exception, current_user.id)
+    except crud.CalendarConflict as e:
+        return _calendar_conflict_response(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not db_exception:
+        raise HTTPException(status_code=404, detail="Calendar event not found")
+    return db_exception
+
+@app.delete("/calendar/{event_id}/exceptions/{exception_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Calendar"])
+async def delete_calendar_event_exception_endpoint(event_id: int, exception_id: int, db: AsyncSession = Depends(get_async_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    if not await crud.delete_calendar_event_exception_async(db, event_id, exception_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Calendar event exception not found")
+
+MAX_CALENDAR_WINDOW = timedelta(days=366)
+
+def _check_calendar_window(start: datetime, end: datetime):
+    if end <= start:
+        raise HTTPException(status_code=400, detail="'to' must be after 'from'")
+    if end - start > MAX_CALENDAR_WINDOW:
+        raise HTTPException(status_code=400, detail="Calendar window is too large")
 
 @app.get("/calendar/", response_model=List[schemas.CalendarEvent], tags=["Calendar"])
-def read_calendar_events_endpoint(skip: int = 0, limit: int = Query(100, le=100), db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
-    return crud.get_calendar_events(db, current_user.id, skip=skip, limit=limit)
+async def read_calendar_events_endpoint(
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    skip: int = 0,
+    limit: int = Query(100, le=100),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    if start is None and end is None:
+        return await crud.get_calendar_events_async(db, current_user.id, skip=skip, limit=limit)
+    if start is None or end is None:
+        raise HTTPException(status_code=400, detail="Both 'from' and 'to' are required")
+    _check_calendar_window(start, end)
+    return await crud.get_calendar_events_in_range_async(db, current_user.id, start, end)
+
+@app.get("/calendar/free-slots", response_model=List[schemas.FreeSlot], tags=["Calendar"])
+async def read_free_slots_endpoint(
+    start: datetime = Query(..., alias="from"),
+    end: datetime = Query(..., alias="to"),
+    realtor_id: Optional[int] = None,
+    property_id: Optional[int] = None,
+    min_minutes: int = Query(30, ge=1, le=24 * 60),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.Realtor = Depends(get_current_active_realtor),
+):
+    _check_calendar_window(start, end)
+    if realtor_id is None and property_id is None:
+        realtor_id = current_user.id
+    if realtor_id is not None and realtor_id != current_user.id:
+        # Чужой календарь смотрим только в пределах своего агентства
+        colleague = await crud.get_realtor_async(db, realtor_id)
+        if not colleague or colleague.agency_id != current_user.agency_id:
+            raise HTTPException(status_code=404, detail="Realtor not found")
+    slots = await crud.find_free_slots_async(
+        db, start, end, timedelta(minutes=min_minutes), realtor_id=realtor_id, property_id=property_id
+    )
+    return [schemas.FreeSlot(start=slot_start, end=slot_end) for slot_start, slot_end in slots]
+
+@app.get("/calendar/agency", response_model=List[schemas.CalendarEvent], tags=["Calendar"])
+async def read_agency_calendar_endpoint(
+    start: datetime = Query(..., alias="from"),
+    end: datetime = Query(..., alias="to"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.Realtor = Depends(get_current_active_manager),
+):
+    _check_calendar_window(start, end)
+    return await crud.get_agency_calendar_events_async(db, current_user.agency_id, start, end)
 
 # Documents
 @app.post("/documents/upload", response_model=schemas.Document, tags=["Documents"])
-def upload_document_endpoint(property_id: int = None, file: UploadFile = File(...), db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(UPLOADS_DIR, unique_filename)
-    with open(file_path, "wb") as buffer:
-        buffer.write(file.file.read())
-    doc_create = schemas.DocumentCreate(filename=file.filename, filepath=file_path, agency_id=current_user.agency_id, property_id=property_id)
-    return crud.create_document(db, doc_create, current_user.id)
+def upload_document_endpoint(property_id: int = None, file: UploadFile = File(...), db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    try:
+        upload_path, size, checksum = storage.receive_upload(file.file, UPLOADS_DIR)
+    except storage.UploadTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File exceeds {storage.MAX_UPLOAD_BYTES} bytes",
+        )
+    doc_create = schemas.DocumentCreate(
+        filename=file.filename,
+        filepath=storage.blob_path(UPLOADS_DIR, checksum),
+        agency_id=current_user.agency_id,
+        property_id=property_id,
+        content_type=file.content_type,
+        size=size,
+        checksum=checksum,
+    )
+    try:
+        return crud.store_document(db, doc_create, current_user.id, upload_path)
+    finally:
+        # Если blob уже был, временный файл не понадобился
+        storage.discard(upload_path)
+
+@app.delete("/documents/{doc_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Documents"])
+def delete_document_endpoint(doc_id: int, db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    if not crud.delete_document(db, doc_id, current_user.agency_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+
+@app.get("/documents/{doc_id}/download", tags=["Documents"])
+def download_document_endpoint(doc_id: int, if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    doc = crud.get_document(db, doc_id, current_user.agency_id)
+    if not doc or not os.path.isfile(doc.filepath):
+        raise HTTPException(status_code=404, detail="Document not found")
+    headers = {"Cache-Control": "private, no-cache"}
+    if doc.checksum:
+        # Сильный ETag по содержимому; 304 отдаем, не открывая файл
+        etag = f'"{doc.checksum}"'
+        headers["ETag"] = etag
+        if if_none_match and (
+            if_none_match.strip() == "*"
+            or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+        ):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # FileResponse сам обслуживает Range/If-Range, а при поддержке сервером
+    # расширения http.response.pathsend отдает файл через sendfile без копирования
+    return FileResponse(
+        doc.filepath,
+        filename=doc.filename,
+        media_type=doc.content_type or "application/octet-stream",
+        headers=headers,
+    )
+
+# System
+@app.get("/system/password-pool", tags=["System"])
+def password_pool_stats(current_user: schemas.Realtor = Depends(get_current_active_admin)):
+    return passwords.pool.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["System"])
+def metrics_endpoint():
+    pool = passwords.pool.stats()
+    routed = replicas.router.stats()["routed"]
+    hub = pubsub.hub.stats()
+    cache = response_cache.cache.stats()
+    return PlainTextResponse(
+        metrics.render([
+            ("password_pool_in_flight", "Задачи bcrypt в работе и в очереди", "gauge", [({}, pool["in_flight"])]),
+            ("password_pool_queue_depth", "Задачи bcrypt в очереди", "gauge", [({}, pool["queue_depth"])]),
+            ("password_pool_completed_total", "Выполненные задачи bcrypt", "counter", [({}, pool["completed"])]),
+            ("password_pool_rejected_total", "Отклоненные из-за переполнения задачи bcrypt", "counter", [({}, pool["rejected"])]),
+            ("principal_cache_requests_total", "Обращения к кэшу профилей", "counter", [
+                ({"result": "hit"}, principal_cache.hits), ({"result": "miss"}, principal_cache.misses),
+            ]),
+            ("db_routed_requests_total", "Сессии по типу БД", "counter", [
+                ({"target": target}, count) for target, count in routed.items()
+            ]),
+            ("notification_stream_subscribers", "Открытые потоки уведомлений", "gauge", [({}, hub["subscribers"])]),
+            ("notification_events_total", "События уведомлений", "counter", [
+                ({"stage": stage}, hub[stage]) for stage in ("published", "delivered", "dropped")
+            ]),
+            ("response_cache_requests_total", "Обращения к кэшу чтений", "counter", [
+                ({"cache": name, "result": result}, stats[key])
+                for name, stats in sorted(cache["caches"].items())
+                for result, key in (("hit", "hits"), ("miss", "misses"))
+            ]),
+            ("response_cache_invalidations_total", "Сбросы тегов кэша чтений", "counter", [({}, cache["invalidations"])]),
+            ("response_cache_entries", "Записи в кэше чтений процесса", "gauge", [
+                ({}, cache["entries"])
+            ] if cache["entries"] is not None else []),
+        ]),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+@app.get("/system/replicas", tags=["System"])
+def replica_stats(current_user: schemas.Realtor = Depends(get_current_active_admin)):
+    return replicas.router.stats()
+
+@app.get("/system/cache", tags=["System"])
+def response_cache_stats(current_user: schemas.Realtor = Depends(get_current_active_admin)):
+    # Доля попаданий по видам чтений - для подбора RESPONSE_CACHE_MAXSIZE и TTL
+    return response_cache.cache.stats()
 
 # Stats
 @app.get("/stats/me", response_model=schemas.RealtorStats, tags=["Stats"])
-def get_my_stats_endpoint(db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_realtor)):
+def get_my_stats_endpoint(db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
     return crud.get_realtor_stats(db, realtor_id=current_user.id)
 
+@app.get("/stats/me/monthly", response_model=List[schemas.MonthlySales], tags=["Stats"])
+def get_my_monthly_sales_endpoint(months: int = Query(12, ge=1, le=120), db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    return crud.get_monthly_sales(db, rollups.SCOPE_REALTOR, current_user.id, months=months)
+
+@app.get("/stats/agency", response_model=schemas.AgencyStats, tags=["Stats"])
+def get_agency_stats_endpoint(db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    stats = crud.get_agency_stats(db, agency_id=current_user.agency_id)
+    if not stats:
+        raise HTTPException(status_code=404, detail="Agency not found")
+    return stats
+
+@app.get("/stats/agency/monthly", response_model=List[schemas.MonthlySales], tags=["Stats"])
+def get_agency_monthly_sales_endpoint(months: int = Query(12, ge=1, le=120), db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    return crud.get_monthly_sales(db, rollups.SCOPE_AGENCY, current_user.agency_id, months=months)
+
+@app.get("/stats/agency/leaderboard", response_model=List[schemas.RealtorStats], tags=["Stats"])
+def get_agency_leaderboard_endpoint(limit: int = Query(100, ge=1, le=500), db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    return crud.get_agency_leaderboard(db, agency_id=current_user.agency_id, limit=limit)
+
 # Events
 @app.post("/events/", response_model=schemas.TrainingEvent, status_code=status.HTTP_201_CREATED, tags=["Events"])
-def create_training_event_endpoint(event: schemas.TrainingEventCreate, db: Session = Depends(get_db), current_user: models.Realtor = Depends(get_current_active_admin)):
+def create_training_event_endpoint(event: schemas.TrainingEventCreate, db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_admin)):
     return crud.create_training_event(db=db, event=event)
 
 @app.get("/events/", response_model=List[schemas.TrainingEvent], tags=["Events"])
-def read_training_events_endpoint(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return crud.get_training_events(db, skip=skip, limit=limit)
\ No newline at end of file
+def read_training_events_endpoint(request: Request, response: Response, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    # Список публичный: его может хранить и общий прокси
+    version = crud.get_training_events_version(db)
+    etag = http_cache.etag(request, version)
+    if http_cache.is_fresh(request, etag, version):
+        return http_cache.not_modified(etag, version, http_cache.PUBLIC_CACHE_CONTROL)
+    response.headers.update(http_cache.headers(etag, version, http_cache.PUBLIC_CACHE_CONTROL))
+    return crud.get_training_events_cached(db, version, skip=skip, limit=limit)
+
+@app.post("/events/{event_id}/registrations", response_model=schemas.EventRegistration, tags=["Events"])
+def register_for_event_endpoint(event_id: int, db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    # Повторный запрос безопасен: вернется уже существующая регистрация
+    registration = crud.register_for_event(db, event_id, current_user.id)
+    if registration is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return registration
+
+@app.delete("/events/{event_id}/registrations/me", status_code=status.HTTP_204_NO_CONTENT, tags=["Events"])
+def cancel_event_registration_endpoint(event_id: int, db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_realtor)):
+    if not crud.cancel_event_registration(db, event_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Registration not found")
+
+@app.get("/events/{event_id}/registrations", response_model=List[schemas.EventRegistration], tags=["Events"])
+def read_event_registrations_endpoint(event_id: int, registration_status: Optional[models.RegistrationStatusEnum] = Query(None, alias="status"), db: Session = Depends(get_db), current_user: schemas.Realtor = Depends(get_current_active_manager)):
+    return crud.get_registrations_for_event(db, event_id, status=registration_status)
\ No newline at end of file
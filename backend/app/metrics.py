@@ -0,0 +1,172 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# Метрики процесса в формате Prometheus: латентность по маршрутам и число/время
+# SQL-запросов на запрос. SQL считается через события engine, а к запросу
+# привязывается через ContextVar - он доходит и до пула потоков Starlette,
+# и до greenlet-ов AsyncSession.run_sync.
+
+logger = logging.getLogger("realtypro.metrics")
+
+# Запрос, сделавший больше запросов к БД, пишет предупреждение (признак N+1)
+SQL_QUERY_WARN_THRESHOLD = int(os.getenv("SQL_QUERY_WARN_THRESHOLD", "25"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """Гистограмма с метками; значения корзин накопительные, как ждет Prometheus."""
+
+    def __init__(self, name: str, help_text: str, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        for labels, (counts, total) in sorted(series.items()):
+            base = _labels(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(zip(self.label_names, labels), le=le)} {cumulative}")
+            lines.append(f"{self.name}_sum{base} {_number(total)}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs, **extra) -> str:
+    items = [f'{name}="{_escape(value)}"' for name, value in list(pairs) + list(extra.items())]
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _gauges(name: str, help_text: str, kind: str, samples):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{_labels(labels.items())} {_number(value)}" for labels, value in samples)
+    return lines
+
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Время обработки запроса", ("method", "route", "status"), LATENCY_BUCKETS
+)
+http_request_db_queries = Histogram(
+    "http_request_db_queries", "Число SQL-запросов на HTTP-запрос", ("method", "route"), QUERY_COUNT_BUCKETS
+)
+http_request_db_duration = Histogram(
+    "http_request_db_duration_seconds", "Суммарное время SQL на HTTP-запрос", ("method", "route"), LATENCY_BUCKETS
+)
+db_query_duration = Histogram("db_query_duration_seconds", "Время одного SQL-запроса", ("engine",), LATENCY_BUCKETS)
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+_request_stats: ContextVar[RequestStats | None] = ContextVar("request_stats", default=None)
+
+
+def instrument_engine(engine, name: str):
+    """Подписывает engine (или sync_engine у AsyncEngine) на подсчет SQL."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        db_query_duration.observe(elapsed, name)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        # Запрос упал - снимаем его отметку времени, чтобы стек не рос
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: время запроса до конца тела ответа и SQL за время запроса."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_stats.reset(token)
+            elapsed = time.perf_counter() - started
+            # Шаблон пути, а не сам путь: иначе каждый id - новая серия
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            http_request_duration.observe(elapsed, method, route, str(status_code))
+            http_request_db_queries.observe(stats.queries, method, route)
+            http_request_db_duration.observe(stats.db_seconds, method, route)
+            if stats.queries > SQL_QUERY_WARN_THRESHOLD:
+                logger.warning(
+                    "%s %s made %d SQL queries (%.1f ms), threshold is %d",
+                    method, route, stats.queries, stats.db_seconds * 1000, SQL_QUERY_WARN_THRESHOLD,
+                )
+
+
+def render(extra_sections=()):
+    """Текст для GET /metrics (формат Prometheus 0.0.4)."""
+    lines = []
+    for histogram in (http_request_duration, http_request_db_queries, http_request_db_duration, db_query_duration):
+        lines.extend(histogram.render())
+    for name, help_text, kind, samples in extra_sections:
+        lines.extend(_gauges(name, help_text, kind, samples))
+    return "\n".join(lines) + "\n"
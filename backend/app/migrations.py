@@ -0,0 +1,431 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, Enum, Float, ForeignKey, Integer, MetaData, String, Table, UniqueConstraint, bindparam,
+    false, func, inspect, select, text, update,
+)
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn, CreateTable, Index
+
+from . import geo, models, rollups, search
+
+# Версионные миграции схемы. Применяются отдельной командой (python migrate.py)
+# один раз, а не при старте каждого воркера. Каждая миграция выполняется в
+# своей транзакции и записывается в schema_migrations. Шаги написаны так,
+# чтобы их можно было применить и к базе, созданной старым create_all:
+# недостающее добавляется, существующее не трогается.
+
+_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+BACKFILL_BATCH_SIZE = 1000
+# Ключ pg_advisory_xact_lock: два одновременных migrate.py не применят миграцию дважды
+_PG_LOCK_KEY = 72_310_019
+
+
+def _columns(conn, table: str):
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+def _indexes(conn, table: str):
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+
+def _add_column(conn, table: str, column: Column):
+    if column.name not in _columns(conn, table):
+        spec = CreateColumn(column).compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {spec}"))
+
+
+# Схема на момент первой миграции, зафиксированная здесь, а не взятая из
+# models: миграция должна создавать одно и то же, как бы ни менялись модели.
+# Все, что появилось позже, добавляют следующие миграции явно.
+_baseline = MetaData()
+
+Table(
+    "agencies", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String, unique=True, index=True),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+)
+Table(
+    "realtors", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("email", String, unique=True, index=True),
+    Column("full_name", String),
+    Column("hashed_password", String),
+    Column("is_active", Boolean),
+    Column("role", Enum("realtor", "manager", "admin", name="realtorroleenum"), nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+    Column("agency_id", Integer, ForeignKey("agencies.id")),
+)
+Table(
+    "properties", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("title", String, index=True),
+    Column("description", String),
+    Column("price", Integer),
+    Column("address", String),
+    Column("latitude", Float),
+    Column("longitude", Float),
+    Column("status", Enum("for_sale", "reserved", "sold", "archived", name="propertystatusenum")),
+    Column("agency_id", Integer, ForeignKey("agencies.id")),
+    Column("realtor_id", Integer, ForeignKey("realtors.id")),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+    Column("updated_at", DateTime(timezone=True)),
+)
+Table(
+    "property_history", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("property_id", Integer, ForeignKey("properties.id")),
+    Column("realtor_id", Integer, ForeignKey("realtors.id")),
+    Column("action", String),
+    Column("old_value", String),
+    Column("new_value", String),
+    Column("timestamp", DateTime(timezone=True), server_default=func.now()),
+)
+Table(
+    "notifications", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("realtor_id", Integer, ForeignKey("realtors.id")),
+    Column("message", String),
+    Column("is_read", Boolean),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+)
+Table(
+    "calendar_events", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("property_id", Integer, ForeignKey("properties.id")),
+    Column("realtor_id", Integer, ForeignKey("realtors.id")),
+    Column("event_type", Enum("viewing", "deal", "other", name="calendareventtype")),
+    Column("title", String),
+    Column("description", String),
+    Column("start_time", DateTime(timezone=True)),
+    Column("end_time", DateTime(timezone=True)),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+)
+Table(
+    "documents", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("filename", String),
+    Column("filepath", String, unique=True),
+    Column("realtor_id", Integer, ForeignKey("realtors.id")),
+    Column("agency_id", Integer, ForeignKey("agencies.id")),
+    Column("property_id", Integer, ForeignKey("properties.id")),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+)
+Table(
+    "training_events", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("title", String, index=True),
+    Column("description", String),
+    Column("speaker", String),
+    Column("start_time", DateTime(timezone=True)),
+    Column("end_time", DateTime(timezone=True)),
+    Column("is_online", Boolean),
+    Column("link", String),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+)
+Table(
+    "event_registrations", _baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("event_id", Integer, ForeignKey("training_events.id")),
+    Column("realtor_id", Integer, ForeignKey("realtors.id")),
+    Column("registered_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+# Таблицы, появившиеся до версионных миграций (их создавал create_all при
+# старте); добавляются в m0002. В отдельных MetaData, но со ссылками на
+# базовые таблицы, чтобы компилировались внешние ключи
+_pre_migrations = MetaData()
+_baseline.tables["calendar_events"].to_metadata(_pre_migrations)
+
+Table(
+    "stats_rollups", _pre_migrations,
+    Column("scope", String(16), primary_key=True),
+    Column("scope_id", Integer, primary_key=True),
+    Column("for_sale_count", Integer, nullable=False),
+    Column("sold_count", Integer, nullable=False),
+    Column("total_sales_value", Integer, nullable=False),
+)
+Table(
+    "monthly_sales_rollups", _pre_migrations,
+    Column("scope", String(16), primary_key=True),
+    Column("scope_id", Integer, primary_key=True),
+    Column("month", String(7), primary_key=True),
+    Column("sold_count", Integer, nullable=False),
+    Column("sold_value", Integer, nullable=False),
+)
+Table(
+    "calendar_event_exceptions", _pre_migrations,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("event_id", Integer, ForeignKey("calendar_events.id", ondelete="CASCADE"), nullable=False),
+    Column("original_start", DateTime(timezone=True), nullable=False),
+    Column("cancelled", Boolean, nullable=False),
+    Column("start_time", DateTime(timezone=True)),
+    Column("end_time", DateTime(timezone=True)),
+    Column("title", String),
+    Column("description", String),
+    UniqueConstraint("event_id", "original_start", name="uq_calendar_event_exceptions_occurrence"),
+)
+Table(
+    "document_blobs", _pre_migrations,
+    Column("checksum", String(64), primary_key=True),
+    Column("size", Integer),
+    Column("ref_count", Integer, nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+
+def _create_index(conn, name: str, table: str, columns, unique: bool = False):
+    """Создает индекс по именам колонок, если его еще нет.
+
+    Таблица описывается только нужными колонками, так что индекс не зависит
+    ни от моделей, ни от остальных колонок таблицы.
+    """
+    if name in _indexes(conn, table):
+        return
+    table_obj = Table(table, MetaData(), *(Column(c) for c in columns))
+    Index(name, *(table_obj.c[c] for c in columns), unique=unique).create(conn)
+
+
+def m0001_initial_schema(conn):
+    # Базовые таблицы, которых еще нет. Существующие (от старого create_all)
+    # не меняются - этим занимаются следующие миграции
+    _baseline.create_all(conn)
+
+
+def m0002_add_missing_columns(conn):
+    for name in ("stats_rollups", "monthly_sales_rollups", "calendar_event_exceptions", "document_blobs"):
+        _pre_migrations.tables[name].create(conn, checkfirst=True)
+    _add_column(conn, "properties", Column("geohash", String(12)))
+    _add_column(conn, "properties", Column("sold_at", DateTime(timezone=True)))
+    _add_column(conn, "documents", Column("content_type", String))
+    _add_column(conn, "documents", Column("size", Integer))
+    _add_column(conn, "documents", Column("checksum", String(64)))
+    _add_column(conn, "calendar_events", Column("is_long", Boolean, nullable=False, server_default=false()))
+    _add_column(conn, "calendar_events", Column("recurrence", String))
+    _add_column(conn, "calendar_events", Column("recurrence_end", DateTime(timezone=True)))
+
+
+def m0003_documents_filepath_not_unique(conn):
+    # Копии одного файла ссылаются на общий blob, поэтому filepath больше не уникален
+    unique = [
+        constraint for constraint in inspect(conn).get_unique_constraints("documents")
+        if constraint["column_names"] == ["filepath"]
+    ]
+    if not unique:
+        return
+    if conn.dialect.name != "sqlite":
+        for constraint in unique:
+            conn.execute(text(f'ALTER TABLE documents DROP CONSTRAINT "{constraint["name"]}"'))
+        return
+    # SQLite не умеет удалять ограничения - пересобираем таблицу: базовая
+    # схема с колонками из m0002 и без UNIQUE
+    scratch = MetaData()
+    for name in ("agencies", "realtors", "properties"):
+        # Таблицы, на которые ссылаются внешние ключи, нужны для компиляции DDL
+        _baseline.tables[name].to_metadata(scratch)
+    rebuilt = Table(
+        "documents_rebuilt", scratch,
+        Column("id", Integer, primary_key=True),
+        Column("filename", String),
+        Column("filepath", String),
+        Column("realtor_id", Integer, ForeignKey("realtors.id")),
+        Column("agency_id", Integer, ForeignKey("agencies.id")),
+        Column("property_id", Integer, ForeignKey("properties.id")),
+        Column("created_at", DateTime(timezone=True), server_default=func.now()),
+        Column("content_type", String),
+        Column("size", Integer),
+        Column("checksum", String(64)),
+    )
+    conn.execute(CreateTable(rebuilt))
+    names = ", ".join(column.name for column in rebuilt.columns)
+    conn.execute(text(f"INSERT INTO documents_rebuilt ({names}) SELECT {names} FROM documents"))
+    conn.execute(text("DROP TABLE documents"))
+    conn.execute(text("ALTER TABLE documents_rebuilt RENAME TO documents"))
+    # Индексы ушли вместе со старой таблицей; остальные добавит m0004
+    _create_index(conn, "ix_documents_id", "documents", ["id"])
+
+
+# (имя, таблица, колонки) - индексы под горячие запросы
+HOT_QUERY_INDEXES = [
+    # Внешние ключи: выборки по владельцу и проверки при удалении
+    ("ix_realtors_agency_id", "realtors", ["agency_id"]),
+    ("ix_property_history_property_id", "property_history", ["property_id"]),
+    ("ix_property_history_realtor_id", "property_history", ["realtor_id"]),
+    ("ix_documents_agency_id", "documents", ["agency_id"]),
+    ("ix_documents_realtor_id", "documents", ["realtor_id"]),
+    ("ix_documents_property_id", "documents", ["property_id"]),
+    ("ix_event_registrations_event_id", "event_registrations", ["event_id"]),
+    ("ix_event_registrations_realtor_id", "event_registrations", ["realtor_id"]),
+    ("ix_notifications_realtor_created_at", "notifications", ["realtor_id", "created_at"]),
+    # Списки объектов: keyset-пагинация и фильтр по статусу
+    ("ix_properties_created_at_id", "properties", ["created_at", "id"]),
+    ("ix_properties_price_id", "properties", ["price", "id"]),
+    ("ix_properties_status_created_at", "properties", ["status", "created_at", "id"]),
+    ("ix_properties_agency_status_created_at", "properties", ["agency_id", "status", "created_at", "id"]),
+    ("ix_properties_agency_status_price", "properties", ["agency_id", "status", "price", "id"]),
+    ("ix_properties_realtor_status_created_at", "properties", ["realtor_id", "status", "created_at", "id"]),
+    ("ix_properties_geohash", "properties", ["geohash"]),
+    ("ix_documents_checksum", "documents", ["checksum"]),
+    # Календарь: окна по времени у риэлтора и у объекта
+    ("ix_calendar_events_realtor_start", "calendar_events", ["realtor_id", "start_time"]),
+    ("ix_calendar_events_realtor_long_start", "calendar_events", ["realtor_id", "is_long", "start_time"]),
+    ("ix_calendar_events_property_long_start", "calendar_events", ["property_id", "is_long", "start_time"]),
+]
+
+
+def m0004_hot_query_indexes(conn):
+    for name, table, columns in HOT_QUERY_INDEXES:
+        _create_index(conn, name, table, columns)
+
+
+def m0005_search_index(conn):
+    search.ensure_search_index(conn)
+
+
+def m0006_backfill_derived_columns(conn):
+    Property = models.Property
+    Event = models.CalendarEvent
+    # Длинные события (см. crud.CALENDAR_LONG_EVENT): ищутся отдельной веткой запроса
+    if conn.dialect.name == "postgresql":
+        is_long = text("end_time - start_time > interval '1 day'")
+    else:
+        is_long = text("julianday(end_time) - julianday(start_time) > 1")
+    conn.execute(
+        update(Event)
+        .where(Event.start_time.isnot(None), Event.end_time.isnot(None))
+        .values(is_long=is_long)
+    )
+
+    # Geohash для объектов, созданных до гео-индекса
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(Property.id, Property.latitude, Property.longitude)
+            .where(
+                Property.id > last_id,
+                Property.geohash.is_(None),
+                Property.latitude.isnot(None),
+                Property.longitude.isnot(None),
+            )
+            .order_by(Property.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            update(Property).where(Property.id == bindparam("b_id")).values(geohash=bindparam("b_geohash")),
+            [{"b_id": r.id, "b_geohash": geo.encode(r.latitude, r.longitude)} for r in rows],
+        )
+        last_id = rows[-1].id
+
+    # Сводная статистика по уже существующим объектам
+    with Session(bind=conn) as db:
+        rollups.rebuild(db)
+
+
+def m0007_notifications_unread_index(conn):
+    notifications = Table(
+        "notifications", MetaData(),
+        Column("realtor_id", Integer), Column("created_at", DateTime(timezone=True)), Column("is_read", Boolean),
+    )
+    unread = notifications.c.is_read == false()
+    Index(
+        "ix_notifications_realtor_unread", notifications.c.realtor_id, notifications.c.created_at,
+        sqlite_where=unread, postgresql_where=unread,
+    ).create(conn, checkfirst=True)
+
+
+def m0008_event_registration_capacity(conn):
+    Registration = Table(
+        "event_registrations", MetaData(),
+        Column("id", Integer), Column("event_id", Integer), Column("realtor_id", Integer), Column("status", String(10)),
+    )
+    Event = Table("training_events", MetaData(), Column("id", Integer), Column("seats_taken", Integer))
+    _add_column(conn, "training_events", Column("capacity", Integer))
+    _add_column(conn, "training_events", Column("seats_taken", Integer, nullable=False, server_default="0"))
+    _add_column(conn, "event_registrations", Column("status", String(10), nullable=False, server_default="confirmed"))
+
+    # Дубли, оставшиеся от регистрации без ограничения: оставляем самую раннюю
+    first = select(func.min(Registration.c.id)).group_by(Registration.c.event_id, Registration.c.realtor_id)
+    conn.execute(Registration.delete().where(Registration.c.id.not_in(first)))
+    _create_index(conn, "uq_event_registrations_event_realtor", "event_registrations", ["event_id", "realtor_id"], unique=True)
+    _create_index(
+        conn, "ix_event_registrations_event_status", "event_registrations",
+        ["event_id", "status", "registered_at", "id"],
+    )
+
+    # Все существующие регистрации подтверждены и занимают места
+    taken = (
+        select(func.count())
+        .where(
+            Registration.c.event_id == Event.c.id,
+            Registration.c.status == "confirmed",
+        )
+        .scalar_subquery()
+    )
+    conn.execute(Event.update().values(seats_taken=taken))
+
+
+def m0009_change_counters(conn):
+    Table(
+        "change_counters", MetaData(),
+        Column("scope", String(16), primary_key=True),
+        Column("scope_id", Integer, primary_key=True),
+        Column("version", Integer, nullable=False),
+        Column("changed_at", DateTime(timezone=True), nullable=False),
+    ).create(conn, checkfirst=True)
+
+
+MIGRATIONS = [
+    (1, "initial_schema", m0001_initial_schema),
+    (2, "add_missing_columns", m0002_add_missing_columns),
+    (3, "documents_filepath_not_unique", m0003_documents_filepath_not_unique),
+    (4, "hot_query_indexes", m0004_hot_query_indexes),
+    (5, "search_index", m0005_search_index),
+    (6, "backfill_derived_columns", m0006_backfill_derived_columns),
+    (7, "notifications_unread_index", m0007_notifications_unread_index),
+    (8, "event_registration_capacity", m0008_event_registration_capacity),
+    (9, "change_counters", m0009_change_counters),
+]
+
+
+def applied_versions(conn):
+    if not inspect(conn).has_table(schema_migrations.name):
+        return set()
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def pending(engine):
+    """Миграции, которые еще не применены к БД."""
+    with engine.connect() as conn:
+        applied = applied_versions(conn)
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in applied]
+
+
+def upgrade(engine, log=print):
+    """Применяет недостающие миграции по порядку. Возвращает их версии."""
+    with engine.begin() as conn:
+        _metadata.create_all(conn)
+    done = []
+    for version, name, migrate in MIGRATIONS:
+        with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _PG_LOCK_KEY})
+            if version in applied_versions(conn):
+                continue
+            log(f"Применение миграции {version:04d}_{name}...")
+            migrate(conn)
+            conn.execute(schema_migrations.insert().values(
+                version=version, name=name, applied_at=datetime.now(timezone.utc)
+            ))
+        done.append(version)
+    return done
@@ -1,8 +1,8 @@
 from sqlalchemy import (
-    Boolean, Column, DateTime, ForeignKey, Integer, String, Enum as SqlEnum, Float
+    Boolean, Column, DateTime, ForeignKey, Index, Integer, String, UniqueConstraint, Enum as SqlEnum, Float
 )
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import false, func
 import enum
 
 from .database import Base
@@ -34,7 +34,7 @@ class Realtor(Base):
     is_active = Column(Boolean, default=True)
     role = Column(SqlEnum(RealtorRoleEnum), default=RealtorRoleEnum.realtor, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    agency_id = Column(Integer, ForeignKey("agencies.id"))
+    agency_id = Column(Integer, ForeignKey("agencies.id"), index=True)
 
     agency = relationship("Agency", back_populates="realtors")
 
@@ -56,23 +56,36 @@ class Property(Base):
     address = Column(String)
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
+    geohash = Column(String(12), nullable=True, index=True) # Ячейка сетки для гео-поиска, см. geo.py
     status = Column(SqlEnum(PropertyStatusEnum), default=PropertyStatusEnum.for_sale)
     agency_id = Column(Integer, ForeignKey("agencies.id"))
     realtor_id = Column(Integer, ForeignKey("realtors.id"))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    sold_at = Column(DateTime(timezone=True), nullable=True) # Когда объект перешел в статус sold
 
     agency = relationship("Agency")
     realtor = relationship("Realtor")
     history = relationship("PropertyHistory", back_populates="property")
 
+    # Составные индексы под keyset-пагинацию: фильтр по равенству идет первым,
+    # затем ключ сортировки и id как разрыв равенства.
+    __table_args__ = (
+        Index("ix_properties_created_at_id", "created_at", "id"),
+        Index("ix_properties_price_id", "price", "id"),
+        Index("ix_properties_agency_status_created_at", "agency_id", "status", "created_at", "id"),
+        Index("ix_properties_agency_status_price", "agency_id", "status", "price", "id"),
+        Index("ix_properties_realtor_status_created_at", "realtor_id", "status", "created_at", "id"),
+        Index("ix_properties_status_created_at", "status", "created_at", "id"),
+    )
+
 
 class PropertyHistory(Base):
     __tablename__ = "property_history"
 
     id = Column(Integer, primary_key=True, index=True)
-    property_id = Column(Integer, ForeignKey("properties.id"))
-    realtor_id = Column(Integer, ForeignKey("realtors.id"))
+    property_id = Column(Integer, ForeignKey("properties.id"), index=True)
+    realtor_id = Column(Integer, ForeignKey("realtors.id"), index=True)
     action = Column(String)
     old_value = Column(String, nullable=True)
     new_value = Column(String, nullable=True)
@@ -82,6 +95,37 @@ class PropertyHistory(Base):
     realtor = relationship("Realtor")
 
 
+class StatsRollup(Base):
+    """Сводные показатели риэлтора или агентства, поддерживаются инкрементально (см. rollups.py)."""
+    __tablename__ = "stats_rollups"
+
+    scope = Column(String(16), primary_key=True) # "realtor" или "agency"
+    scope_id = Column(Integer, primary_key=True)
+    for_sale_count = Column(Integer, nullable=False, default=0)
+    sold_count = Column(Integer, nullable=False, default=0)
+    total_sales_value = Column(Integer, nullable=False, default=0)
+
+
+class MonthlySalesRollup(Base):
+    __tablename__ = "monthly_sales_rollups"
+
+    scope = Column(String(16), primary_key=True)
+    scope_id = Column(Integer, primary_key=True)
+    month = Column(String(7), primary_key=True) # "YYYY-MM" по sold_at
+    sold_count = Column(Integer, nullable=False, default=0)
+    sold_value = Column(Integer, nullable=False, default=0)
+
+
+class ChangeCounter(Base):
+    """Номер версии набора данных для ETag, растет при каждой записи (см. versions.py)."""
+    __tablename__ = "change_counters"
+
+    scope = Column(String(16), primary_key=True) # "property", "agency" или "events"
+    scope_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    changed_at = Column(DateTime(timezone=True), nullable=False)
+
+
 class Notification(Base):
     __tablename__ = "notifications"
 
@@ -93,6 +137,19 @@ class Notification(Base):
 
     realtor = relationship("Realtor")
 
+    __table_args__ = (
+        Index("ix_notifications_realtor_created_at", "realtor_id", "created_at"),
+        # Частичный индекс только по непрочитанным: счетчик и фильтр unread_only
+        # читают лишь их, сколько бы прочитанных ни накопилось
+        Index(
+            "ix_notifications_realtor_unread",
+            "realtor_id",
+            "created_at",
+            sqlite_where=is_read == false(),
+            postgresql_where=is_read == false(),
+        ),
+    )
+
 
 class CalendarEventType(enum.Enum):
     viewing = "viewing"
@@ -111,10 +168,43 @@ class CalendarEvent(Base):
     description = Column(String)
     start_time = Column(DateTime(timezone=True))
     end_time = Column(DateTime(timezone=True))
+    # Событие длиннее CALENDAR_LONG_EVENT (см. crud). Короткие события ищутся
+    # по ограниченному с двух сторон диапазону start_time, длинные - отдельно.
+    is_long = Column(Boolean, nullable=False, default=False)
+    # Правило повторения (см. recurrence.py). Для серии start_time/end_time -
+    # первое вхождение, а recurrence_end - конец последнего (NULL - бесконечно)
+    recurrence = Column(String, nullable=True)
+    recurrence_end = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     property = relationship("Property")
     realtor = relationship("Realtor")
+    exceptions = relationship("CalendarEventException", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        Index("ix_calendar_events_realtor_start", "realtor_id", "start_time"),
+        Index("ix_calendar_events_realtor_long_start", "realtor_id", "is_long", "start_time"),
+        Index("ix_calendar_events_property_long_start", "property_id", "is_long", "start_time"),
+    )
+
+
+class CalendarEventException(Base):
+    """Изменение одного вхождения повторяющегося события: перенос или отмена."""
+    __tablename__ = "calendar_event_exceptions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(Integer, ForeignKey("calendar_events.id", ondelete="CASCADE"), nullable=False)
+    # Исходное начало вхождения по правилу - по нему вхождение и опознается
+    original_start = Column(DateTime(timezone=True), nullable=False)
+    cancelled = Column(Boolean, nullable=False, default=False)
+    start_time = Column(DateTime(timezone=True), nullable=True)
+    end_time = Column(DateTime(timezone=True), nullable=True)
+    title = Column(String, nullable=True)
+    description = Column(String, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("event_id", "original_start", name="uq_calendar_event_exceptions_occurrence"),
+    )
 
 
 class Document(Base):
@@ -122,10 +212,13 @@ class Document(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String)
-    filepath = Column(String, unique=True)
-    realtor_id = Column(Integer, ForeignKey("realtors.id"))
-    agency_id = Column(Integer, ForeignKey("agencies.id"))
-    property_id = Column(Integer, ForeignKey("properties.id"), nullable=True)
+    filepath = Column(String) # Путь к blob-у; у копий одного файла он общий
+    content_type = Column(String, nullable=True)
+    size = Column(Integer, nullable=True) # Размер в байтах
+    checksum = Column(String(64), nullable=True, index=True) # sha256 содержимого, он же ETag
+    realtor_id = Column(Integer, ForeignKey("realtors.id"), index=True)
+    agency_id = Column(Integer, ForeignKey("agencies.id"), index=True)
+    property_id = Column(Integer, ForeignKey("properties.id"), nullable=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     realtor = relationship("Realtor")
@@ -133,6 +226,16 @@ class Document(Base):
     property = relationship("Property")
 
 
+class DocumentBlob(Base):
+    """Файл в хранилище по содержимому и число документов, которые на него ссылаются."""
+    __tablename__ = "document_blobs"
+
+    checksum = Column(String(64), primary_key=True)
+    size = Column(Integer)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class TrainingEvent(Base):
     __tablename__ = "training_events"
 
@@ -144,18 +247,41 @@ class TrainingEvent(Base):
     end_time = Column(DateTime(timezone=True))
     is_online = Column(Boolean, default=False)
     link = Column(String, nullable=True) # Ссылка на вебинар/трансляцию
+    capacity = Column(Integer, nullable=True) # Число мест; None - без ограничения
+    # Занятые места (подтвержденные регистрации). Меняется только под
+    # блокировкой строки события, поэтому не расходится с регистрациями
+    seats_taken = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     registrations = relationship("EventRegistration", back_populates="event")
 
 
+class RegistrationStatusEnum(enum.Enum):
+    confirmed = "confirmed"
+    waitlisted = "waitlisted"  # Лист ожидания: мест нет, ждет отмены чужой регистрации
+
+
 class EventRegistration(Base):
     __tablename__ = "event_registrations"
 
     id = Column(Integer, primary_key=True, index=True)
-    event_id = Column(Integer, ForeignKey("training_events.id"))
-    realtor_id = Column(Integer, ForeignKey("realtors.id"))
+    event_id = Column(Integer, ForeignKey("training_events.id"), index=True)
+    realtor_id = Column(Integer, ForeignKey("realtors.id"), index=True)
+    # Строка, а не тип ENUM в БД: колонку можно добавить миграцией без CREATE TYPE
+    status = Column(
+        SqlEnum(RegistrationStatusEnum, native_enum=False),
+        nullable=False,
+        default=RegistrationStatusEnum.confirmed,
+        server_default=RegistrationStatusEnum.confirmed.name,
+    )
     registered_at = Column(DateTime(timezone=True), server_default=func.now())
 
     event = relationship("TrainingEvent", back_populates="registrations")
-    realtor = relationship("Realtor") 
\ No newline at end of file
+    realtor = relationship("Realtor")
+
+    __table_args__ = (
+        # Повторная регистрация (двойной клик, гонка запросов) упирается в индекс
+        Index("uq_event_registrations_event_realtor", "event_id", "realtor_id", unique=True),
+        # Очередь листа ожидания в порядке регистрации
+        Index("ix_event_registrations_event_status", "event_id", "status", "registered_at", "id"),
+    )
@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from .database import engine
+
+# Доставка уведомлений подписчикам GET /notifications/stream (SSE) без опроса.
+# crud публикует события после коммита, хаб раздает их очередям подключений
+# нужного риэлтора. Между воркерами события передает backend:
+#   NOTIFY_BACKEND=local     - один процесс (по умолчанию, им же проверяется локально)
+#   NOTIFY_BACKEND=postgres  - несколько воркеров на одной PostgreSQL, LISTEN/NOTIFY
+
+logger = logging.getLogger("realtypro.pubsub")
+
+NOTIFY_BACKEND = os.getenv("NOTIFY_BACKEND", "local")
+# Непрочитанные подключением события сверх этого числа отбрасываются,
+# а клиенту уходит resync - перечитать список через GET /notifications/
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "100"))
+# Комментарий-пинг в пустом потоке, чтобы прокси не закрывали соединение
+NOTIFY_HEARTBEAT_SECONDS = float(os.getenv("NOTIFY_HEARTBEAT_SECONDS", "15"))
+NOTIFY_PG_CHANNEL = "realtypro_notifications"
+
+
+class Subscription:
+    """Очередь событий одного подключения. Живет в event loop этого подключения."""
+
+    def __init__(self, hub, realtor_id: int, loop, maxsize: int):
+        self.hub = hub
+        self.realtor_id = realtor_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def _offer(self, payload):
+        if self.queue.full():
+            self.overflowed = True
+            self.hub.dropped += 1
+            return
+        self.queue.put_nowait(payload)
+
+    def _lost(self):
+        # События могли пройти мимо (например, пока переподключался LISTEN):
+        # клиенту уйдет resync, как при переполнении очереди
+        self.overflowed = True
+
+    async def get(self, timeout: float):
+        """Следующее событие или None, если за timeout ничего не пришло."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class LocalBackend:
+    """Один процесс: опубликованное сразу раздается своим подписчикам."""
+
+    name = "local"
+
+    def __init__(self):
+        self._deliver = None
+
+    def start(self, deliver, lost):
+        self._deliver = deliver
+
+    def publish(self, events):
+        if self._deliver is not None:
+            self._deliver(events)
+
+    def stop(self):
+        self._deliver = None
+
+
+class PostgresBackend:
+    """Несколько воркеров: NOTIFY из любого воркера, LISTEN в потоке каждого."""
+
+    name = "postgres"
+
+    def __init__(self, engine, channel: str = NOTIFY_PG_CHANNEL):
+        self.engine = engine
+        self.channel = channel
+        self._stop = threading.Event()
+        self._listener = None
+
+    def start(self, deliver, lost):
+        if self._listener is not None:
+            return
+        self._stop.clear()
+        self._listener = threading.Thread(
+            target=self._listen, args=(deliver, lost), name="notify-listen", daemon=True
+        )
+        self._listener.start()
+
+    def publish(self, events):
+        self._notify([json.dumps(e) for e in events])
+
+    def _notify(self, payloads):
+        # По одному NOTIFY на событие: полезная нагрузка ограничена 8000 байт
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                [{"channel": self.channel, "payload": payload} for payload in payloads],
+            )
+
+    def _connect(self):
+        """DBAPI-соединение в autocommit для LISTEN."""
+        connection = self.engine.raw_connection()
+        # Соединение слушает до остановки - в пул его не возвращаем
+        connection.detach()
+        dbapi_connection = connection.driver_connection
+        dbapi_connection.autocommit = True
+        return dbapi_connection
+
+    def _listen(self, deliver, lost):
+        reconnecting = False
+        while not self._stop.is_set():
+            dbapi_connection = None
+            try:
+                dbapi_connection = self._connect()
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                if reconnecting:
+                    # NOTIFY, отправленные без слушателя, не доходят
+                    lost()
+                    reconnecting = False
+                while not self._stop.is_set():
+                    if select.select([dbapi_connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    events = []
+                    while dbapi_connection.notifies:
+                        events.append(json.loads(dbapi_connection.notifies.pop(0).payload))
+                    if events:
+                        deliver(events)
+            except Exception:
+                logger.exception("Notification listener failed, reconnecting")
+                reconnecting = True
+                self._stop.wait(1.0)
+            finally:
+                if dbapi_connection is not None:
+                    try:
+                        dbapi_connection.close()
+                    except Exception:
+                        pass
+
+    def stop(self):
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.join(timeout=5)
+            self._listener = None
+
+
+class NotificationHub:
+    def __init__(self, backend):
+        self.backend = backend
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, realtor_id: int) -> Subscription:
+        """Подписка текущего event loop на события риэлтора."""
+        subscription = Subscription(self, realtor_id, asyncio.get_running_loop(), NOTIFY_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(realtor_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.realtor_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.realtor_id]
+
+    def publish(self, events):
+        """Публикует события (словари с realtor_id). Можно вызывать из любого потока."""
+        if not events:
+            return
+        with self._lock:
+            self.published += len(events)
+        try:
+            self.backend.publish(events)
+        except Exception:
+            # Уведомление уже в БД: клиент увидит его при следующем чтении списка
+            logger.exception("Failed to publish %d notification events", len(events))
+
+    def deliver(self, events):
+        """Раздает события локальным подписчикам; вызывается backend-ом."""
+        for payload in events:
+            with self._lock:
+                subscriptions = list(self._subscribers.get(payload.get("realtor_id"), ()))
+                self.delivered += len(subscriptions)
+            for subscription in subscriptions:
+                try:
+                    subscription.loop.call_soon_threadsafe(subscription._offer, payload)
+                except RuntimeError:
+                    # Event loop подключения уже закрыт
+                    self.unsubscribe(subscription)
+
+    def lost(self):
+        """Помечает все подписки как пропустившие события; вызывается backend-ом."""
+        with self._lock:
+            subscriptions = [s for group in self._subscribers.values() for s in group]
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._lost)
+            except RuntimeError:
+                self.unsubscribe(subscription)
+
+    def start(self):
+        self.backend.start(self.deliver, self.lost)
+
+    def stop(self):
+        self.backend.stop()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.backend.name,
+                "subscribers": sum(len(s) for s in self._subscribers.values()),
+                "published": self.published,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+            }
+
+
+def make_backend(name: str, engine):
+    if name == "local":
+        return LocalBackend()
+    if name == "postgres":
+        if engine.dialect.name != "postgresql":
+            raise ValueError("NOTIFY_BACKEND=postgres requires a PostgreSQL database")
+        return PostgresBackend(engine)
+    raise ValueError(f"Unknown NOTIFY_BACKEND: {name}")
+
+
+def format_sse(payload, event_name: str = "notification") -> str:
+    return f"event: {event_name}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def publish_on_commit(db: Session, events):
+    """Откладывает публикацию до коммита сессии; при откате события пропадают."""
+    db.info.setdefault("pending_notifications", []).extend(events)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending(session):
+    events = session.info.pop("pending_notifications", None)
+    if events:
+        hub.publish(events)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending(session):
+    session.info.pop("pending_notifications", None)
+
+
+hub = NotificationHub(make_backend(NOTIFY_BACKEND, engine))
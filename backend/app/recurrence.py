@@ -0,0 +1,177 @@
+import calendar
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from .scheduling import align
+
+# Повторяющиеся события: в БД хранится одна строка с правилом в духе RRULE
+# (RFC 5545), а конкретные вхождения вычисляются генератором только внутри
+# запрошенного окна. Поддерживается подмножество правила:
+#   FREQ=DAILY|WEEKLY|MONTHLY;INTERVAL=n;COUNT=n|UNTIL=YYYYMMDD[THHMMSS[Z]];BYDAY=MO,WE,...
+# Шаг считается по "настенному" времени start_time события.
+
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY")
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+MAX_COUNT = 10000
+
+Rule = namedtuple("Rule", "freq interval count until byday")
+
+
+def parse_rule(text: str):
+    """Разбирает строку правила. Ошибки формата - ValueError."""
+    parts = {}
+    for item in text.strip().upper().split(";"):
+        if not item:
+            continue
+        key, sep, value = item.partition("=")
+        if not sep or not value:
+            raise ValueError(f"Invalid recurrence part: {item}")
+        parts[key] = value
+
+    freq = parts.pop("FREQ", None)
+    if freq not in FREQUENCIES:
+        raise ValueError(f"FREQ must be one of {', '.join(FREQUENCIES)}")
+    interval = _positive_int(parts.pop("INTERVAL", "1"), "INTERVAL")
+    count = parts.pop("COUNT", None)
+    until = parts.pop("UNTIL", None)
+    if count is not None and until is not None:
+        raise ValueError("COUNT and UNTIL are mutually exclusive")
+    if count is not None:
+        count = _positive_int(count, "COUNT")
+        if count > MAX_COUNT:
+            raise ValueError(f"COUNT must not exceed {MAX_COUNT}")
+    if until is not None:
+        until = _parse_until(until)
+    byday = parts.pop("BYDAY", None)
+    if byday is not None:
+        if freq != "WEEKLY":
+            raise ValueError("BYDAY is supported only for FREQ=WEEKLY")
+        days = byday.split(",")
+        if any(day not in WEEKDAYS for day in days):
+            raise ValueError(f"BYDAY values must be among {', '.join(WEEKDAYS)}")
+        byday = tuple(sorted({WEEKDAYS.index(day) for day in days}))
+    if parts:
+        raise ValueError(f"Unsupported recurrence parts: {', '.join(sorted(parts))}")
+    return Rule(freq, interval, count, until, byday)
+
+
+def format_rule(rule: Rule):
+    """Каноническая запись правила, которая сохраняется в БД."""
+    parts = [f"FREQ={rule.freq}"]
+    if rule.interval != 1:
+        parts.append(f"INTERVAL={rule.interval}")
+    if rule.byday:
+        parts.append("BYDAY=" + ",".join(WEEKDAYS[day] for day in rule.byday))
+    if rule.count is not None:
+        parts.append(f"COUNT={rule.count}")
+    if rule.until is not None:
+        parts.append("UNTIL=" + rule.until.strftime("%Y%m%dT%H%M%S"))
+    return ";".join(parts)
+
+
+def _positive_int(value: str, name: str):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+    if number < 1:
+        raise ValueError(f"{name} must be positive")
+    return number
+
+
+def _parse_until(value: str):
+    value = value.rstrip("Z")
+    for fmt in ("%Y%m%dT%H%M%S", "%Y%m%d"):
+        try:
+            until = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        # Дата без времени включает весь день
+        return until if "T" in value else until.replace(hour=23, minute=59, second=59)
+    raise ValueError("UNTIL must look like YYYYMMDD or YYYYMMDDTHHMMSS")
+
+
+def _add_months(moment: datetime, months: int):
+    month_index = moment.month - 1 + months
+    year, month = moment.year + month_index // 12, month_index % 12 + 1
+    if moment.day > calendar.monthrange(year, month)[1]:
+        # Как в RFC 5545: 31-е число в коротком месяце пропускается
+        return None
+    return moment.replace(year=year, month=month)
+
+
+def _periods(rule: Rule, dtstart: datetime, after: datetime | None):
+    """Пары (число вхождений до периода, старты периода) начиная с периода, где может быть after."""
+    if rule.freq == "MONTHLY":
+        # Месяцев мало даже за десятилетия, поэтому просто идем по порядку
+        seen, k = 0, 0
+        while True:
+            start = _add_months(dtstart, k * rule.interval)
+            starts = [start] if start is not None else []
+            yield seen, starts
+            seen += len(starts)
+            k += 1
+
+    if rule.freq == "DAILY":
+        base, length, offsets = dtstart, timedelta(days=rule.interval), (timedelta(0),)
+    else:
+        days = rule.byday or (dtstart.weekday(),)
+        base = dtstart - timedelta(days=dtstart.weekday())
+        length = timedelta(weeks=rule.interval)
+        offsets = tuple(timedelta(days=day) for day in days)
+    first = [base + offset for offset in offsets if base + offset >= dtstart]
+
+    # Периоды целиком раньше after пропускаем арифметически, не перебирая их
+    k = 0
+    if after is not None and after > base:
+        k = (after - base) // length
+    seen = 0 if k == 0 else len(first) + (k - 1) * len(offsets)
+    while True:
+        if k == 0:
+            starts = first
+        else:
+            period = base + k * length
+            starts = [period + offset for offset in offsets]
+        yield seen, starts
+        seen += len(starts)
+        k += 1
+
+
+def iter_starts(rule: Rule, dtstart: datetime, after: datetime | None = None):
+    """Начала вхождений по возрастанию, не раньше after."""
+    until = align(rule.until, dtstart) if rule.until is not None else None
+    if after is not None:
+        after = align(after, dtstart)
+    for seen, starts in _periods(rule, dtstart, after):
+        for index, start in enumerate(starts, start=seen):
+            if rule.count is not None and index >= rule.count:
+                return
+            if until is not None and start > until:
+                return
+            if after is None or start >= after:
+                yield start
+
+
+def occurrences(rule: Rule, dtstart: datetime, duration: timedelta, start: datetime, end: datetime):
+    """Пары (начало, конец) вхождений, пересекающихся с окном [start, end)."""
+    end = align(end, dtstart)
+    for occurrence_start in iter_starts(rule, dtstart, after=start - duration + timedelta(microseconds=1)):
+        if occurrence_start >= end:
+            return
+        yield occurrence_start, occurrence_start + duration
+
+
+def is_occurrence(rule: Rule, dtstart: datetime, moment: datetime):
+    return next(iter_starts(rule, dtstart, after=moment), None) == align(moment, dtstart)
+
+
+def series_end(rule: Rule, dtstart: datetime, duration: timedelta):
+    """Конец последнего вхождения (или верхняя оценка); None для бесконечной серии."""
+    if rule.until is not None:
+        return align(rule.until, dtstart) + duration
+    if rule.count is not None:
+        last = dtstart
+        for last in iter_starts(rule, dtstart):
+            pass
+        return last + duration
+    return None
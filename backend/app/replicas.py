@@ -0,0 +1,154 @@
+import hashlib
+import itertools
+import os
+import threading
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .database import make_async_engine, make_engine
+
+# Маршрутизация чтения на реплики. Запросы безопасными методами (GET/HEAD)
+# получают сессию на одну из реплик по кругу; все остальное, а также чтение
+# клиента, который только что писал, идет на основную БД. Реплики задаются
+# через DATABASE_REPLICA_URLS (через запятую); без нее все идет на основную.
+#
+# Локально можно проверить на двух файлах SQLite:
+#   DATABASE_REPLICA_URLS=sqlite:///./replica.db (копия realtypro.db)
+
+REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Сколько секунд после записи клиент читает с основной БД (read-your-own-writes)
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "10"))
+
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class ReplicaWriteError(RuntimeError):
+    """Попытка записи через сессию, открытую на реплике."""
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.engine = make_engine(url)
+        self.async_engine = make_async_engine(url)
+        self.healthy = True
+        self.checked_at = None
+        self.error = None
+        for sync_engine in (self.engine, self.async_engine.sync_engine):
+            event.listen(sync_engine, "handle_error", self._on_error)
+
+    def _on_error(self, context):
+        # Обрыв соединения - выводим реплику из ротации до следующей проверки
+        if context.is_disconnect:
+            self.healthy = False
+            self.error = str(context.original_exception)
+
+    def check(self):
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        except Exception as e:
+            self.healthy, self.error = False, str(e)
+        else:
+            self.healthy, self.error = True, None
+        self.checked_at = time.time()
+
+
+class ReplicaRouter:
+    def __init__(self, urls):
+        self.replicas = [Replica(url) for url in urls]
+        self._order = itertools.cycle(range(len(self.replicas))) if self.replicas else None
+        self._lock = threading.Lock()
+        # Ключ клиента -> недавно писал. Кэш процесса: в другом воркере
+        # клиент может увидеть отставание реплики
+        self._recent_writers = TTLCache(maxsize=100_000, ttl=REPLICA_STICKY_SECONDS)
+        self._stop = threading.Event()
+        self._checker = None
+        self.routed_to_replica = 0
+        self.routed_to_primary = 0
+
+    def choose(self):
+        """Следующая здоровая реплика по кругу или None."""
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[next(self._order)]
+                if replica.healthy:
+                    return replica
+        return None
+
+    def route(self, request):
+        """Реплика для запроса или None, если он должен идти на основную БД."""
+        if not self.replicas or request.method not in SAFE_METHODS:
+            replica = None
+        elif self._recent_writers.get(client_key(request)):
+            replica = None
+        else:
+            replica = self.choose()
+        with self._lock:
+            if replica is None:
+                self.routed_to_primary += 1
+            else:
+                self.routed_to_replica += 1
+        return replica
+
+    def note_write(self, request):
+        self._recent_writers.set(client_key(request), True)
+
+    def start(self):
+        if not self.replicas or self._checker is not None:
+            return
+        self._stop.clear()
+        self._checker = threading.Thread(target=self._check_loop, name="replica-health", daemon=True)
+        self._checker.start()
+
+    def _check_loop(self):
+        while not self._stop.is_set():
+            for replica in self.replicas:
+                replica.check()
+            self._stop.wait(REPLICA_HEALTH_INTERVAL)
+
+    async def shutdown(self):
+        self._stop.set()
+        if self._checker is not None:
+            self._checker.join(timeout=REPLICA_HEALTH_INTERVAL)
+            self._checker = None
+        for replica in self.replicas:
+            replica.engine.dispose()
+            await replica.async_engine.dispose()
+
+    def stats(self):
+        with self._lock:
+            routed = {"replica": self.routed_to_replica, "primary": self.routed_to_primary}
+        return {
+            "routed": routed,
+            "sticky_seconds": REPLICA_STICKY_SECONDS,
+            "replicas": [
+                {"url": _safe_url(r), "healthy": r.healthy, "checked_at": r.checked_at, "error": r.error}
+                for r in self.replicas
+            ],
+        }
+
+
+def client_key(request):
+    # Токен не храним как есть - только его хэш
+    credentials = request.headers.get("authorization")
+    if credentials:
+        return hashlib.sha256(credentials.encode()).hexdigest()
+    return request.client.host if request.client else ""
+
+
+def _safe_url(replica: Replica):
+    return replica.engine.url.render_as_string(hide_password=True)
+
+
+@event.listens_for(Session, "before_flush")
+def _forbid_replica_writes(session, flush_context, instances):
+    if session.info.get("replica"):
+        raise ReplicaWriteError("Write attempted on a read replica session")
+
+
+router = ReplicaRouter(REPLICA_URLS)
@@ -0,0 +1,238 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+
+# Кэш результатов горячих чтений (списки событий и объектов, календари).
+# Записи помечаются тегами (агентство, объект, риэлтор); запись в crud после
+# коммита сбрасывает свои теги. Сброс - это новое поколение тега, а поколения
+# входят в ключ, поэтому чтение, начатое до коммита, не может положить в кэш
+# старые данные под новый ключ. Backend выбирается RESPONSE_CACHE_BACKEND:
+#   local  - LRU с TTL в памяти процесса (по умолчанию, им же проверяется локально)
+#   redis  - общий кэш воркеров (RESPONSE_CACHE_REDIS_URL); пакет redis не входит
+#            в requirements.txt: pip install redis (см. check_cache.py)
+#   off    - без кэша
+# Ключ включает и версию набора данных из БД (versions.py), поэтому другие
+# воркеры видят запись сразу, а тело совпадает с ETag при любом backend.
+# Значения - JSON-совместимые тела ответов: в общий Redis не кладется ничего,
+# что при чтении могло бы выполнить код.
+
+logger = logging.getLogger("realtypro.cache")
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "local")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "30"))
+RESPONSE_CACHE_MAXSIZE = int(os.getenv("RESPONSE_CACHE_MAXSIZE", "10000"))
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Виды тегов
+TAG_PROPERTY = "property"            # объект по id
+TAG_AGENCY_PROPERTIES = "agency"     # объекты агентства
+TAG_ALL_PROPERTIES = "properties"    # списки без фильтра по агентству
+TAG_EVENTS = "events"                # обучающие события
+TAG_CALENDAR = "calendar"            # календарь риэлтора
+TAG_AGENCY_CALENDAR = "agency-calendar"
+
+_MISSING = object()
+
+
+def tag(kind: str, entity_id=None) -> str:
+    return kind if entity_id is None else f"{kind}:{entity_id}"
+
+
+class LocalBackend:
+    """Записи в TTLCache процесса, поколения тегов - в словаре."""
+
+    name = "local"
+    # Больше тегов не помним: словарь очищается, а все записи становятся недоступны
+    MAX_GENERATIONS = 100_000
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._generations = {}
+        self._sequence = 0
+        # Поколение тега, которого нет в словаре. После очистки словаря оно
+        # новое, поэтому записи со старыми поколениями больше не совпадут
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def set(self, key, value):
+        self.entries.set(key, value)
+
+    def generations(self, tags):
+        with self._lock:
+            return tuple(self._generations.get(t, self._floor) for t in tags)
+
+    def invalidate(self, tags):
+        with self._lock:
+            if len(self._generations) + len(tags) > self.MAX_GENERATIONS:
+                self._generations.clear()
+                self._sequence += 1
+                self._floor = self._sequence
+            for t in tags:
+                self._sequence += 1
+                self._generations[t] = self._sequence
+
+    def size(self):
+        return len(self.entries), self.entries.maxsize
+
+
+class RedisBackend:
+    """Общий кэш воркеров. Поколения - счетчики INCR без TTL: Redis должен
+    вытеснять только ключи с TTL (maxmemory-policy volatile-lru)."""
+
+    name = "redis"
+
+    def __init__(self, url: str, ttl: float, prefix: str = "realtypro:cache", client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise RuntimeError("RESPONSE_CACHE_BACKEND=redis requires the 'redis' package: pip install redis") from e
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        data = self.client.get(f"{self.prefix}:e:{key}")
+        return default if data is None else json.loads(data)
+
+    def set(self, key, value):
+        self.client.set(f"{self.prefix}:e:{key}", json.dumps(value), px=int(self.ttl * 1000))
+
+    def generations(self, tags):
+        if not tags:
+            return ()
+        values = self.client.mget([f"{self.prefix}:g:{t}" for t in tags])
+        return tuple(int(v) if v is not None else 0 for v in values)
+
+    def invalidate(self, tags):
+        pipeline = self.client.pipeline(transaction=False)
+        for t in tags:
+            pipeline.incr(f"{self.prefix}:g:{t}")
+        pipeline.execute()
+
+    def size(self):
+        return None, None
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats = {}
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def _count(self, name: str, hit: bool):
+        with self._lock:
+            stats = self._stats.setdefault(name, [0, 0])
+            stats[0 if hit else 1] += 1
+
+    def _lookup(self, name: str, args, tags):
+        if self.backend is None:
+            return None, _MISSING
+        try:
+            # Поколения читаем до загрузки данных: если запись успеет сбросить
+            # тег, загруженное ляжет под уже неактуальный ключ
+            generations = self.backend.generations(tags)
+            digest = hashlib.sha256(repr((args, tuple(tags), generations)).encode()).hexdigest()
+            key = f"{name}:{digest}"
+            value = self.backend.get(key, _MISSING)
+        except Exception:
+            logger.warning("Response cache lookup failed for %s", name, exc_info=True)
+            return None, _MISSING
+        self._count(name, value is not _MISSING)
+        return key, value
+
+    def _store(self, key, value):
+        if key is None:
+            return
+        try:
+            self.backend.set(key, value)
+        except Exception:
+            logger.warning("Response cache store failed", exc_info=True)
+
+    def get_or_load(self, name: str, args, tags, load):
+        """Значение из кэша или результат load(), который кладется в кэш.
+
+        load должен возвращать JSON-совместимые данные (тело ответа, а не ORM).
+        """
+        key, value = self._lookup(name, args, tags)
+        if value is _MISSING:
+            value = load()
+            self._store(key, value)
+        return value
+
+    async def get_or_load_async(self, name: str, args, tags, load):
+        key, value = self._lookup(name, args, tags)
+        if value is _MISSING:
+            value = await load()
+            self._store(key, value)
+        return value
+
+    def invalidate(self, *tags):
+        if self.backend is None or not tags:
+            return
+        with self._lock:
+            self.invalidations += 1
+        try:
+            self.backend.invalidate(tags)
+        except Exception:
+            # Тег не сброшен: устаревшие записи доживут до TTL
+            logger.exception("Response cache invalidation failed for %s", tags)
+
+    def stats(self):
+        with self._lock:
+            names = {name: {"hits": hits, "misses": misses} for name, (hits, misses) in self._stats.items()}
+            invalidations = self.invalidations
+        for stats in names.values():
+            total = stats["hits"] + stats["misses"]
+            stats["hit_ratio"] = stats["hits"] / total if total else None
+        size, maxsize = self.backend.size() if self.backend is not None else (None, None)
+        return {
+            "backend": self.backend.name if self.backend is not None else "off",
+            "ttl": RESPONSE_CACHE_TTL,
+            "entries": size,
+            "maxsize": maxsize,
+            "invalidations": invalidations,
+            "caches": names,
+        }
+
+
+def invalidate_on_commit(db: Session, *tags):
+    """Сбрасывает теги после коммита сессии; при откате ничего не сбрасывается."""
+    db.info.setdefault("invalidate_tags", set()).update(tags)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_pending(session):
+    tags = session.info.pop("invalidate_tags", None)
+    if tags:
+        cache.invalidate(*tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending(session):
+    session.info.pop("invalidate_tags", None)
+
+
+def make_backend(name: str):
+    if name == "off":
+        return None
+    if name == "local":
+        return LocalBackend(RESPONSE_CACHE_MAXSIZE, RESPONSE_CACHE_TTL)
+    if name == "redis":
+        return RedisBackend(RESPONSE_CACHE_REDIS_URL, RESPONSE_CACHE_TTL)
+    raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND: {name}")
+
+
+cache = ResponseCache(make_backend(RESPONSE_CACHE_BACKEND))
@@ -0,0 +1,150 @@
+from collections import defaultdict, namedtuple
+from datetime import datetime, timezone
+
+from sqlalchemy import case, delete, func, insert, literal, update
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import dialect_insert
+
+# Предрассчитанные показатели риэлторов и агентств. crud обновляет их
+# инкрементально в той же транзакции, что и сам объект, поэтому чтение
+# статистики не зависит от размера портфеля. rebuild() пересчитывает все с нуля.
+
+SCOPE_REALTOR = "realtor"
+SCOPE_AGENCY = "agency"
+
+PropertySnapshot = namedtuple("PropertySnapshot", "realtor_id agency_id status price sold_month")
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def month_key(moment: datetime | None):
+    return moment.strftime("%Y-%m") if moment else None
+
+
+def snapshot(realtor_id, agency_id, status, price, sold_at):
+    """Часть состояния объекта, от которой зависят показатели."""
+    if status is not None:
+        status = models.PropertyStatusEnum(status)
+    return PropertySnapshot(realtor_id, agency_id, status, price, month_key(sold_at))
+
+
+def property_snapshot(db_property: models.Property):
+    return snapshot(
+        db_property.realtor_id, db_property.agency_id, db_property.status, db_property.price, db_property.sold_at
+    )
+
+
+def _contributions(snap: PropertySnapshot | None):
+    if snap is None:
+        return
+    is_sold = snap.status == models.PropertyStatusEnum.sold
+    for_sale = 1 if snap.status == models.PropertyStatusEnum.for_sale else 0
+    sold = 1 if is_sold else 0
+    value = (snap.price or 0) if is_sold else 0
+    for scope, scope_id in ((SCOPE_REALTOR, snap.realtor_id), (SCOPE_AGENCY, snap.agency_id)):
+        if scope_id is not None:
+            yield scope, scope_id, for_sale, sold, value, snap.sold_month if is_sold else None
+
+
+def apply_changes(db: Session, changes):
+    """Применяет к сводкам пары (до, после); None означает, что объекта не было.
+
+    Все изменения сворачиваются в один upsert на таблицу. Коммит остается за вызывающим кодом.
+    """
+    totals = defaultdict(lambda: [0, 0, 0])
+    monthly = defaultdict(lambda: [0, 0])
+    for before, after in changes:
+        if before == after:
+            continue
+        for sign, snap in ((-1, before), (1, after)):
+            for scope, scope_id, for_sale, sold, value, month in _contributions(snap):
+                total = totals[(scope, scope_id)]
+                total[0] += sign * for_sale
+                total[1] += sign * sold
+                total[2] += sign * value
+                if month is not None:
+                    bucket = monthly[(scope, scope_id, month)]
+                    bucket[0] += sign * sold
+                    bucket[1] += sign * value
+
+    upsert = dialect_insert(db)
+    total_rows = [
+        {"scope": scope, "scope_id": scope_id, "for_sale_count": d[0], "sold_count": d[1], "total_sales_value": d[2]}
+        for (scope, scope_id), d in totals.items() if any(d)
+    ]
+    if total_rows:
+        statement = upsert(models.StatsRollup)
+        statement = statement.on_conflict_do_update(
+            index_elements=[models.StatsRollup.scope, models.StatsRollup.scope_id],
+            set_={
+                "for_sale_count": models.StatsRollup.for_sale_count + statement.excluded.for_sale_count,
+                "sold_count": models.StatsRollup.sold_count + statement.excluded.sold_count,
+                "total_sales_value": models.StatsRollup.total_sales_value + statement.excluded.total_sales_value,
+            },
+        )
+        db.execute(statement, total_rows)
+
+    monthly_rows = [
+        {"scope": scope, "scope_id": scope_id, "month": month, "sold_count": d[0], "sold_value": d[1]}
+        for (scope, scope_id, month), d in monthly.items() if any(d)
+    ]
+    if monthly_rows:
+        statement = upsert(models.MonthlySalesRollup)
+        statement = statement.on_conflict_do_update(
+            index_elements=[models.MonthlySalesRollup.scope, models.MonthlySalesRollup.scope_id, models.MonthlySalesRollup.month],
+            set_={
+                "sold_count": models.MonthlySalesRollup.sold_count + statement.excluded.sold_count,
+                "sold_value": models.MonthlySalesRollup.sold_value + statement.excluded.sold_value,
+            },
+        )
+        db.execute(statement, monthly_rows)
+
+
+def _month_expression(db: Session, column):
+    if db.get_bind().dialect.name == "postgresql":
+        return func.to_char(column, "YYYY-MM")
+    return func.strftime("%Y-%m", column)
+
+
+def rebuild(db: Session):
+    """Полный пересчет сводок по таблице properties, для починки после сбоев и миграций."""
+    Property = models.Property
+    is_sold = Property.status == models.PropertyStatusEnum.sold
+    # Проданные до появления sold_at объекты относим к месяцу последнего изменения
+    db.execute(
+        update(Property)
+        .where(is_sold, Property.sold_at.is_(None))
+        .values(sold_at=func.coalesce(Property.updated_at, Property.created_at))
+    )
+    db.execute(delete(models.StatsRollup))
+    db.execute(delete(models.MonthlySalesRollup))
+
+    month = _month_expression(db, Property.sold_at)
+    for scope, column in ((SCOPE_REALTOR, Property.realtor_id), (SCOPE_AGENCY, Property.agency_id)):
+        totals = (
+            db.query(
+                literal(scope),
+                column,
+                func.count(case((Property.status == models.PropertyStatusEnum.for_sale, 1))),
+                func.count(case((is_sold, 1))),
+                func.coalesce(func.sum(case((is_sold, Property.price), else_=0)), 0),
+            )
+            .filter(column.isnot(None))
+            .group_by(column)
+        )
+        db.execute(insert(models.StatsRollup).from_select(
+            ["scope", "scope_id", "for_sale_count", "sold_count", "total_sales_value"], totals.statement
+        ))
+        months = (
+            db.query(literal(scope), column, month, func.count(), func.coalesce(func.sum(Property.price), 0))
+            .filter(is_sold, column.isnot(None))
+            .group_by(column, month)
+        )
+        db.execute(insert(models.MonthlySalesRollup).from_select(
+            ["scope", "scope_id", "month", "sold_count", "sold_value"], months.statement
+        ))
+    db.commit()
@@ -0,0 +1,49 @@
+import heapq
+from datetime import datetime, timedelta, timezone
+
+# Поиск свободных окон в календаре: занятые интервалы, уже отсортированные
+# по началу, сливаются одним проходом (sweep line), а свободные окна - это
+# промежутки между слитыми блоками внутри запрошенного диапазона.
+
+
+def align(moment: datetime, like: datetime):
+    """Приводит moment к той же "осведомленности" о часовом поясе, что и like.
+
+    SQLite возвращает даты без часового пояса (в том виде, как их прислал
+    клиент), PostgreSQL - с поясом, а параметры запроса могут быть любыми.
+    """
+    if like.tzinfo is None and moment.tzinfo is not None:
+        return moment.replace(tzinfo=None)
+    if like.tzinfo is not None and moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def merge_busy(*sorted_intervals):
+    """Сливает несколько отсортированных по началу потоков интервалов в непересекающиеся блоки."""
+    merged = []
+    for start, end in heapq.merge(*sorted_intervals, key=lambda interval: interval[0]):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def free_slots(busy, start: datetime, end: datetime, min_duration: timedelta):
+    """Свободные окна внутри [start, end) не короче min_duration."""
+    slots = []
+    cursor = start
+    for busy_start, busy_end in busy:
+        busy_start, busy_end = align(busy_start, start), align(busy_end, start)
+        if busy_end <= cursor:
+            continue
+        if busy_start >= end:
+            break
+        if busy_start - cursor >= min_duration:
+            slots.append((cursor, busy_start))
+        cursor = max(cursor, busy_end)
+    if end - cursor >= min_duration:
+        slots.append((cursor, end))
+    return slots
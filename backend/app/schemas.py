@@ -2,8 +2,8 @@ from datetime import datetime
 from typing import List, Optional
 from enum import Enum
 
-from pydantic import BaseModel
-from .models import RealtorRoleEnum
+from pydantic import BaseModel, Field
+from .models import RealtorRoleEnum, RegistrationStatusEnum
 
 
 # Realtor Schemas
@@ -53,6 +53,14 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     email: str | None = None
+    realtor_id: int | None = None
+    agency_id: int | None = None
+    role: RealtorRoleEnum | None = None
+
+
+class RealtorAccessUpdate(BaseModel):
+    role: RealtorRoleEnum | None = None
+    is_active: bool | None = None
 
 
 class PropertyStatusEnum(str, Enum):
@@ -62,6 +70,16 @@ class PropertyStatusEnum(str, Enum):
     archived = "archived"
 
 
+class PropertySortKey(str, Enum):
+    created_at = "created_at"
+    price = "price"
+
+
+class SortOrder(str, Enum):
+    asc = "asc"
+    desc = "desc"
+
+
 class PropertyBase(BaseModel):
     title: str
     description: str | None = None
@@ -97,6 +115,26 @@ class Property(PropertyBase):
         from_attributes = True
 
 
+class PropertyWithDistance(Property):
+    distance_km: float
+
+
+class BulkFormat(str, Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+
+
+class BulkImportError(BaseModel):
+    row: int
+    error: str
+
+
+class BulkImportResult(BaseModel):
+    created: int
+    failed: int
+    errors: List[BulkImportError] = []
+
+
 class PropertyHistory(BaseModel):
     id: int
     property_id: int
@@ -128,6 +166,20 @@ class Notification(NotificationBase):
         from_attributes = True
 
 
+class NotificationsMarkRead(BaseModel):
+    # None - отметить все непрочитанные
+    ids: Optional[List[int]] = None
+
+
+class NotificationsMarkReadResult(BaseModel):
+    updated: int
+    unread: int
+
+
+class NotificationUnreadCount(BaseModel):
+    unread: int
+
+
 class CalendarEventType(str, Enum):
     viewing = "viewing"
     deal = "deal"
@@ -141,6 +193,8 @@ class CalendarEventBase(BaseModel):
     description: str | None = None
     start_time: datetime
     end_time: datetime
+    # Правило повторения, например "FREQ=WEEKLY;BYDAY=SA;COUNT=10"
+    recurrence: str | None = None
 
 
 class CalendarEventCreate(CalendarEventBase):
@@ -151,11 +205,40 @@ class CalendarEvent(CalendarEventBase):
     id: int
     realtor_id: int
     created_at: datetime
+    # У вхождения серии - его исходное начало по правилу (id у всех вхождений общий)
+    occurrence_start: datetime | None = None
+
+    class Config:
+        from_attributes = True
+
+
+class CalendarEventExceptionCreate(BaseModel):
+    original_start: datetime
+    cancelled: bool = False
+    start_time: datetime | None = None
+    end_time: datetime | None = None
+    title: str | None = None
+    description: str | None = None
+
+
+class CalendarEventException(CalendarEventExceptionCreate):
+    id: int
+    event_id: int
 
     class Config:
         from_attributes = True
 
 
+class CalendarConflictDetail(BaseModel):
+    message: str
+    conflicts: List[CalendarEvent]
+
+
+class FreeSlot(BaseModel):
+    start: datetime
+    end: datetime
+
+
 class DocumentBase(BaseModel):
     filename: str
 
@@ -164,6 +247,9 @@ class DocumentCreate(DocumentBase):
     filepath: str
     agency_id: int
     property_id: int | None = None
+    content_type: str | None = None
+    size: int | None = None
+    checksum: str | None = None
 
 
 class Document(DocumentBase):
@@ -171,6 +257,9 @@ class Document(DocumentBase):
     realtor_id: int
     agency_id: int
     property_id: int | None = None
+    content_type: str | None = None
+    size: int | None = None
+    checksum: str | None = None
     created_at: datetime
 
     class Config:
@@ -180,7 +269,7 @@ class Document(DocumentBase):
 # Schemas for Stats & KPI
 class RealtorStats(BaseModel):
     realtor_id: int
-    full_name: str
+    full_name: str | None = None
     properties_for_sale: int
     properties_sold: int
     total_sales_value: int
@@ -195,6 +284,15 @@ class AgencyStats(BaseModel):
     total_sales_value: int
 
 
+class MonthlySales(BaseModel):
+    month: str
+    sold_count: int
+    sold_value: int
+
+    class Config:
+        from_attributes = True
+
+
 # Schemas for Training Events
 class TrainingEventBase(BaseModel):
     title: str
@@ -204,14 +302,17 @@ class TrainingEventBase(BaseModel):
     end_time: datetime
     is_online: bool = False
     link: str | None = None
+    capacity: int | None = None  # None - без ограничения мест
 
 
 class TrainingEventCreate(TrainingEventBase):
-    pass
+    # Хотя бы одно место: при нуле и меньше все уходили бы в лист ожидания навсегда
+    capacity: int | None = Field(default=None, ge=1)
 
 
 class TrainingEvent(TrainingEventBase):
     id: int
+    seats_taken: int
     created_at: datetime
 
     class Config:
@@ -222,6 +323,7 @@ class EventRegistration(BaseModel):
     id: int
     event_id: int
     realtor_id: int
+    status: RegistrationStatusEnum
     registered_at: datetime
 
     class Config:
@@ -0,0 +1,178 @@
+import re
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from . import models
+
+# Полнотекстовый индекс по title/description/address. Под SQLite это
+# виртуальная таблица FTS5, под PostgreSQL - отдельная таблица с tsvector и
+# GIN-индексом. Индекс обновляется из crud в той же транзакции, что и объект.
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def parse_terms(q: str):
+    return [t.lower() for t in _TOKEN_RE.findall(q)]
+
+
+class SQLiteSearch:
+    # Веса bm25 для колонок title, description, address
+    _WEIGHTS = "10.0, 1.0, 5.0"
+
+    def ensure(self, conn):
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'properties_fts'")
+        ).first()
+        if exists:
+            return False
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE properties_fts USING fts5("
+            "title, description, address, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+        return True
+
+    def rebuild(self, conn):
+        conn.execute(text("DELETE FROM properties_fts"))
+        conn.execute(text(
+            "INSERT INTO properties_fts (rowid, title, description, address) "
+            "SELECT id, coalesce(title, ''), coalesce(description, ''), coalesce(address, '') FROM properties"
+        ))
+
+    def index(self, db: Session, documents):
+        db.execute(text("DELETE FROM properties_fts WHERE rowid = :id"), [{"id": d["id"]} for d in documents])
+        db.execute(
+            text("INSERT INTO properties_fts (rowid, title, description, address) VALUES (:id, :title, :description, :address)"),
+            documents,
+        )
+
+    def search(self, db: Session, terms, filters_sql, params, limit, skip):
+        # Каждый терм ищем как префикс: "ремонт" найдет "ремонтом" и "ремонтированный"
+        params["q"] = " ".join(f'"{t}"*' for t in terms)
+        statement = text(
+            "SELECT properties.* FROM properties_fts "
+            "JOIN properties ON properties.id = properties_fts.rowid "
+            f"WHERE properties_fts MATCH :q{filters_sql} "
+            f"ORDER BY bm25(properties_fts, {self._WEIGHTS}), properties.id "
+            "LIMIT :limit OFFSET :skip"
+        )
+        return db.query(models.Property).from_statement(statement).params(limit=limit, skip=skip, **params).all()
+
+
+class PostgresSearch:
+    _DOCUMENT = (
+        "setweight(to_tsvector('simple', coalesce({title}, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce({address}, '')), 'B') || "
+        "setweight(to_tsvector('simple', coalesce({description}, '')), 'C')"
+    )
+
+    def ensure(self, conn):
+        exists = conn.execute(text("SELECT to_regclass('property_search')")).scalar()
+        if exists:
+            return False
+        conn.execute(text(
+            "CREATE TABLE property_search ("
+            "property_id INTEGER PRIMARY KEY REFERENCES properties (id) ON DELETE CASCADE, "
+            "document TSVECTOR NOT NULL)"
+        ))
+        conn.execute(text("CREATE INDEX ix_property_search_document ON property_search USING GIN (document)"))
+        return True
+
+    def rebuild(self, conn):
+        document = self._DOCUMENT.format(title="title", address="address", description="description")
+        conn.execute(text(
+            f"INSERT INTO property_search (property_id, document) SELECT id, {document} FROM properties "
+            "ON CONFLICT (property_id) DO UPDATE SET document = EXCLUDED.document"
+        ))
+
+    def index(self, db: Session, documents):
+        document = self._DOCUMENT.format(title=":title", address=":address", description=":description")
+        db.execute(
+            text(
+                f"INSERT INTO property_search (property_id, document) VALUES (:id, {document}) "
+                "ON CONFLICT (property_id) DO UPDATE SET document = EXCLUDED.document"
+            ),
+            documents,
+        )
+
+    def search(self, db: Session, terms, filters_sql, params, limit, skip):
+        params["q"] = " & ".join(f"{t}:*" for t in terms)
+        statement = text(
+            "SELECT properties.* FROM property_search "
+            "JOIN properties ON properties.id = property_search.property_id "
+            f"WHERE property_search.document @@ to_tsquery('simple', :q){filters_sql} "
+            "ORDER BY ts_rank(property_search.document, to_tsquery('simple', :q)) DESC, properties.id "
+            "LIMIT :limit OFFSET :skip"
+        )
+        return db.query(models.Property).from_statement(statement).params(limit=limit, skip=skip, **params).all()
+
+
+_BACKENDS = {
+    "sqlite": SQLiteSearch(),
+    "postgresql": PostgresSearch(),
+}
+
+
+def search_document(property_id: int, title: str | None, description: str | None, address: str | None):
+    return {
+        "id": property_id,
+        "title": title or "",
+        "description": description or "",
+        "address": address or "",
+    }
+
+
+def _backend_for(bind):
+    backend = _BACKENDS.get(bind.dialect.name)
+    if backend is None:
+        raise NotImplementedError(f"Full-text search is not supported for {bind.dialect.name}")
+    return backend
+
+
+def ensure_search_index(conn):
+    """Создает индекс, если его еще нет, и заполняет его существующими объектами (см. migrations.py)."""
+    backend = _backend_for(conn)
+    if backend.ensure(conn):
+        backend.rebuild(conn)
+
+
+def rebuild_search_index(engine):
+    backend = _backend_for(engine)
+    with engine.begin() as conn:
+        backend.rebuild(conn)
+
+
+def index_property(db: Session, db_property: models.Property):
+    """Обновляет запись объекта в индексе. Коммит остается за вызывающим кодом."""
+    index_documents(db, [
+        search_document(db_property.id, db_property.title, db_property.description, db_property.address),
+    ])
+
+
+def index_documents(db: Session, documents):
+    """Пакетное обновление индекса документами из search_document()."""
+    if documents:
+        _backend_for(db.get_bind()).index(db, documents)
+
+
+def search_properties(
+    db: Session,
+    q: str,
+    limit: int = 20,
+    skip: int = 0,
+    agency_id: int | None = None,
+    status: str | None = None,
+):
+    terms = parse_terms(q)
+    if not terms:
+        return []
+    filters_sql, params = "", {}
+    if agency_id is not None:
+        filters_sql += " AND properties.agency_id = :agency_id"
+        params["agency_id"] = agency_id
+    if status is not None:
+        # Enum хранится по имени члена, а имена совпадают со значениями
+        filters_sql += " AND properties.status = :status"
+        params["status"] = status
+    return _backend_for(db.get_bind()).search(db, terms, filters_sql, params, limit, skip)
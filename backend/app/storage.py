@@ -0,0 +1,149 @@
+import hashlib
+import os
+import uuid
+
+# Документы хранятся по содержимому: путь blob-а выводится из его sha256,
+# поэтому одинаковые файлы занимают место на диске один раз. Загрузки
+# копируются кусками фиксированного размера во временный файл - в памяти
+# никогда не лежит больше одного куска, а хэш считается на лету.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+# Два уровня каталогов по 256 вариантов: ~65 тыс. каталогов вместо одного
+# плоского каталога на все файлы
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
+_TMP_DIR = "tmp"
+_TRASH_SUFFIX = ".trash"
+
+
+# Запас на заголовки multipart и поля формы сверх самого файла
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Файл превышает MAX_UPLOAD_BYTES."""
+
+
+class UploadLimitMiddleware:
+    """ASGI-middleware: ограничивает тело запросов на загрузку до разбора формы.
+
+    Starlette разбирает multipart и складывает файл во временный файл еще до
+    вызова эндпоинта, так что проверка в receive_upload срабатывает, когда
+    лишнее уже принято и записано. Здесь запрос с Content-Length больше
+    лимита получает 413 сразу, не читая тела, а тело без Content-Length
+    (chunked) считается по мере чтения и обрывается на превышении.
+    """
+
+    def __init__(self, app, paths, max_bytes: int | None = None):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = MAX_UPLOAD_BYTES if max_bytes is None else max_bytes
+        self.limit = self.max_bytes + MULTIPART_OVERHEAD_BYTES
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.limit:
+            await self._reject(send)
+            return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.limit:
+                    # Дальше приложение увидит обрыв соединения, а его ответ
+                    # подменим на 413
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def limited_send(message):
+            if not exceeded:
+                await send(message)
+            elif message["type"] == "http.response.start":
+                await self._reject(send)
+
+        await self.app(scope, limited_receive, limited_send)
+
+    async def _reject(self, send):
+        body = f'{{"detail":"File exceeds {self.max_bytes} bytes"}}'.encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"connection", b"close")],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def blob_path(root: str, checksum: str) -> str:
+    shards = [checksum[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return os.path.join(root, *shards, checksum)
+
+
+def receive_upload(fileobj, root: str, max_bytes: int | None = None):
+    """Копирует поток во временный файл под root. Возвращает (временный путь, размер, sha256)."""
+    if max_bytes is None:
+        max_bytes = MAX_UPLOAD_BYTES
+    tmp_dir = os.path.join(root, _TMP_DIR)
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{uuid.uuid4()}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as buffer:
+            while True:
+                chunk = fileobj.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge()
+                digest.update(chunk)
+                buffer.write(chunk)
+    except BaseException:
+        discard(tmp_path)
+        raise
+    return tmp_path, size, digest.hexdigest()
+
+
+def place_blob(tmp_path: str, path: str):
+    """Переносит загруженный файл на место blob-а, если такого содержимого еще нет."""
+    if os.path.exists(path):
+        discard(tmp_path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+
+
+def discard(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def detach_blob(path: str):
+    """Убирает файл с его пути, оставляя возможность вернуть его через restore_blob.
+
+    Возвращает путь, под которым файл лежит до окончательного purge, или None.
+    """
+    trash_path = f"{path}.{uuid.uuid4().hex}{_TRASH_SUFFIX}"
+    try:
+        os.replace(path, trash_path)
+    except FileNotFoundError:
+        return None
+    return trash_path
+
+
+def restore_blob(trash_path: str, path: str):
+    os.replace(trash_path, path)
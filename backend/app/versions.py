@@ -0,0 +1,70 @@
+from collections import namedtuple
+from datetime import timezone
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import dialect_insert
+from .rollups import utcnow
+
+# Счетчики изменений для условных GET (ETag/Last-Modified). Счетчик растет в
+# той же транзакции, что и сама запись, поэтому версия не может опередить
+# данные или отстать от них. Проверка свежести - чтение одной строки по
+# первичному ключу вместо выборки и сериализации всего ответа.
+#   property/<id>  - объект и его история
+#   agency/<id>    - объекты агентства (списки)
+#   events/0       - список обучающих событий
+#   calendar/<id>  - календарь риэлтора (только ключ кэша чтений, без ETag)
+#   agency_calendar/<id> - календарь агентства (так же)
+
+SCOPE_PROPERTY = "property"
+SCOPE_AGENCY = "agency"
+SCOPE_EVENTS = "events"
+SCOPE_CALENDAR = "calendar"
+SCOPE_AGENCY_CALENDAR = "agency_calendar"
+
+Version = namedtuple("Version", "version changed_at")
+
+
+def bump(db: Session, *keys):
+    """Увеличивает счетчики (scope, scope_id). Коммит остается за вызывающим кодом."""
+    now = utcnow()
+    statement = dialect_insert(db)(models.ChangeCounter)
+    statement = statement.on_conflict_do_update(
+        index_elements=[models.ChangeCounter.scope, models.ChangeCounter.scope_id],
+        set_={"version": models.ChangeCounter.version + 1, "changed_at": statement.excluded.changed_at},
+    )
+    # Один порядок блокировок строк счетчиков во всех транзакциях
+    rows = [
+        {"scope": scope, "scope_id": scope_id, "version": 1, "changed_at": now}
+        for scope, scope_id in sorted(set(keys))
+    ]
+    db.execute(statement, rows)
+
+
+def _version(version, changed_at):
+    if changed_at is not None and changed_at.tzinfo is None:
+        # SQLite возвращает время без пояса; пишем всегда UTC
+        changed_at = changed_at.replace(tzinfo=timezone.utc)
+    return Version(version or 0, changed_at)
+
+
+def current(db: Session, scope: str, scope_id: int = 0) -> Version:
+    """Версия набора данных; (0, None), если он еще не менялся."""
+    row = db.query(models.ChangeCounter.version, models.ChangeCounter.changed_at).filter(
+        models.ChangeCounter.scope == scope, models.ChangeCounter.scope_id == scope_id
+    ).first()
+    return _version(*row) if row else Version(0, None)
+
+
+def scope_total(db: Session, scope: str) -> Version:
+    """Версия всех наборов scope сразу, например объектов всех агентств.
+
+    Сумма счетчиков растет при любом изменении любого из них, а отдельной
+    общей строки, на которой сталкивались бы записи разных агентств, нет.
+    """
+    version, changed_at = db.query(
+        func.sum(models.ChangeCounter.version), func.max(models.ChangeCounter.changed_at)
+    ).filter(models.ChangeCounter.scope == scope).one()
+    return _version(version, changed_at)
@@ -0,0 +1,142 @@
+import argparse
+import random
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from sqlalchemy import func, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, migrations, models, rollups
+from app.database import make_engine
+
+# Нагрузочная проверка регистрации на события: сотни риэлторов одновременно
+# регистрируются (часть - повторно, как при двойном клике) и отменяют
+# регистрацию. После прогона сверяются инварианты: нет дублей, занятых мест
+# не больше вместимости, счетчик совпадает с подтвержденными регистрациями,
+# а лист ожидания не пуст только при заполненном событии.
+# Запускать на отдельной БД - скрипт создает в ней своих риэлторов:
+#   python bench_events.py --url sqlite:///./bench_events.db --registrants 300 --capacity 50
+
+
+def registrant(session_factory, event_id, realtor_id, cancel, latencies, errors, start_barrier):
+    start_barrier.wait()
+    db = session_factory()
+    try:
+        attempts = 2 if random.random() < 0.3 else 1
+        for _ in range(attempts):
+            started = time.perf_counter()
+            try:
+                crud.register_for_event(db, event_id, realtor_id)
+            except OperationalError:
+                db.rollback()
+                errors.append(realtor_id)
+                continue
+            latencies.append(time.perf_counter() - started)
+        if cancel:
+            try:
+                crud.cancel_event_registration(db, event_id, realtor_id)
+            except OperationalError:
+                db.rollback()
+                errors.append(realtor_id)
+    finally:
+        db.close()
+
+
+def check_invariants(db, event_id):
+    Registration = models.EventRegistration
+    db_event = db.get(models.TrainingEvent, event_id)
+    rows = db.query(Registration.realtor_id, Registration.status).filter(Registration.event_id == event_id).all()
+    duplicates = [realtor for realtor, count in Counter(r.realtor_id for r in rows).items() if count > 1]
+    statuses = Counter(r.status for r in rows)
+    confirmed = statuses[models.RegistrationStatusEnum.confirmed]
+    waitlisted = statuses[models.RegistrationStatusEnum.waitlisted]
+    problems = []
+    if duplicates:
+        problems.append(f"дубли регистраций: {len(duplicates)}")
+    if confirmed > db_event.capacity:
+        problems.append(f"подтверждено {confirmed} при вместимости {db_event.capacity}")
+    if db_event.seats_taken != confirmed:
+        problems.append(f"seats_taken={db_event.seats_taken}, подтверждено {confirmed}")
+    if waitlisted and confirmed < db_event.capacity:
+        problems.append(f"свободно {db_event.capacity - confirmed} мест при листе ожидания {waitlisted}")
+    return confirmed, waitlisted, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Конкурентная регистрация на событие с ограничением мест")
+    parser.add_argument("--url", required=True, help="URL отдельной БД для прогона")
+    parser.add_argument("--registrants", type=int, default=300)
+    parser.add_argument("--capacity", type=int, default=50)
+    parser.add_argument("--cancel-share", type=float, default=0.2, help="доля риэлторов, отменяющих регистрацию")
+    args = parser.parse_args()
+
+    # Размер пула PostgreSQL - как у API (DB_POOL_SIZE/DB_MAX_OVERFLOW): потоки ждут соединение в очереди
+    engine = make_engine(args.url)
+    migrations.upgrade(engine, log=lambda message: None)
+    session_factory = sessionmaker(bind=engine, autoflush=False)
+
+    db = session_factory()
+    run = int(time.time())
+    agency = models.Agency(name=f"bench-events-{run}")
+    db.add(agency)
+    db.flush()
+    first_id = db.query(func.coalesce(func.max(models.Realtor.id), 0)).scalar() + 1
+    db.execute(insert(models.Realtor), [
+        {"email": f"bench-{run}-{n}@example.com", "agency_id": agency.id, "role": models.RealtorRoleEnum.realtor}
+        for n in range(args.registrants)
+    ])
+    realtor_ids = [
+        realtor_id for (realtor_id,) in
+        db.query(models.Realtor.id).filter(models.Realtor.agency_id == agency.id, models.Realtor.id >= first_id)
+    ]
+    now = rollups.utcnow()
+    db_event = models.TrainingEvent(
+        title=f"Bench webinar {run}", speaker="bench", start_time=now + timedelta(days=1),
+        end_time=now + timedelta(days=1, hours=1), capacity=args.capacity,
+    )
+    db.add(db_event)
+    db.commit()
+    event_id = db_event.id
+    db.close()
+
+    latencies, errors = [], []
+    barrier = threading.Barrier(len(realtor_ids))
+    threads = [
+        threading.Thread(
+            target=registrant,
+            args=(session_factory, event_id, realtor_id, random.random() < args.cancel_share, latencies, errors, barrier),
+        )
+        for realtor_id in realtor_ids
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    db = session_factory()
+    try:
+        confirmed, waitlisted, problems = check_invariants(db, event_id)
+    finally:
+        db.close()
+    engine.dispose()
+
+    ordered = sorted(latencies) or [0.0]
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(
+        f"{len(realtor_ids)} риэлторов, {args.capacity} мест: {elapsed:.2f} с,"
+        f" p95 регистрации {p95 * 1000:.1f} мс, отказов БД {len(errors)}"
+    )
+    print(f"Подтверждено {confirmed}, в листе ожидания {waitlisted}")
+    for problem in problems:
+        print(f"НАРУШЕНИЕ: {problem}")
+    if not problems:
+        print("Инварианты соблюдены.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from app import response_cache, schemas
+
+# Проверка общего кэша чтений (RESPONSE_CACHE_BACKEND=redis): два экземпляра
+# кэша, как в двух процессах API, на одном Redis. Значение, загруженное одним,
+# второй должен получить без искажений, а сброс тега в одном - увидеть другой.
+# В Redis должен лежать JSON, а не pickle.
+#   python check_cache.py --url redis://localhost:6379/0
+# Без --url Redis заменяет имитация в памяти с теми же командами
+# (GET/SET PX/MGET/INCR в pipeline) - так проверяется сам RedisBackend.
+
+
+class FakeRedis:
+    """Команды Redis, которыми пользуется RedisBackend, в памяти."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.data = {}
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self.data.get(key, (None, None))
+            if expires is not None and expires < time.monotonic():
+                del self.data[key]
+                return None
+            return value
+
+    def set(self, key, value, px=None):
+        if not isinstance(value, (bytes, str, int, float)):
+            raise TypeError(f"Invalid input of type: {type(value).__name__}")
+        data = value.encode() if isinstance(value, str) else value
+        with self._lock:
+            self.data[key] = (data, time.monotonic() + px / 1000 if px else None)
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def incr(self, key):
+        with self._lock:
+            value, expires = self.data.get(key, (b"0", None))
+            value = str(int(value) + 1).encode()
+            self.data[key] = (value, expires)
+            return int(value)
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def incr(self, key):
+        self.commands.append(key)
+
+    def execute(self):
+        return [self.client.incr(key) for key in self.commands]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Общий кэш чтений на Redis между воркерами")
+    parser.add_argument("--url", help="Redis; без него - имитация в памяти")
+    args = parser.parse_args()
+
+    # Свой префикс на прогон, чтобы не задеть кэш работающего API
+    prefix = f"realtypro:check:{uuid.uuid4().hex}"
+    client = None if args.url else FakeRedis()
+    workers = [
+        response_cache.ResponseCache(response_cache.RedisBackend(args.url, ttl=30, prefix=prefix, client=client))
+        for _ in range(2)
+    ]
+    first, second = workers
+    tags = [response_cache.tag(response_cache.TAG_PROPERTY, 1)]
+    body = schemas.Property(
+        id=1, title="Дом \"у моря\" ✓", price=100, address="-", agency_id=1, realtor_id=1,
+        created_at=datetime(2026, 1, 1, tzinfo=timezone.utc),
+    ).model_dump(mode="json")
+    loads = []
+
+    def load(value):
+        def run():
+            loads.append(value)
+            return value
+        return run
+
+    problems = []
+    value = first.get_or_load("property", (1, 1), tags, load(body))
+    cached = second.get_or_load("property", (1, 1), tags, load(None))
+    if cached != body or len(loads) != 1:
+        problems.append(f"второй воркер не получил значение первого: {cached!r}")
+    if value != body:
+        problems.append("значение изменилось при записи в кэш")
+
+    second.invalidate(*tags)
+    changed = {**body, "title": "new"}
+    value = first.get_or_load("property", (1, 1), tags, load(changed))
+    if value != changed or len(loads) != 2:
+        problems.append("сброс тега во втором воркере не виден первому")
+
+    if client is not None:
+        stored = [data for key, (data, _) in client.data.items() if ":e:" in key]
+        if not stored or not all(data.startswith((b"{", b"[")) for data in stored):
+            problems.append(f"в Redis не JSON: {stored[:1]!r}")
+
+    print(f"Кэши: {[worker.stats()['caches'] for worker in workers]}")
+    for problem in problems:
+        print(f"НАРУШЕНИЕ: {problem}")
+    if problems:
+        sys.exit(1)
+    print("Общий кэш между воркерами работает.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import update
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, migrations, models, schemas
+from app.database import make_engine
+
+# Проверка блокировок строк (crud._lock_row): блокировка не должна менять
+# саму строку - ни напрямую, ни через запись в календарь объекта. В SQLite она берется UPDATE-ом, и если бы он задевал колонки
+# с onupdate, у объекта менялся бы updated_at без смены версии для ETag.
+# Запускать на отдельной БД - скрипт создает в ней свои данные:
+#   python check_locks.py --url sqlite:///./check_locks.db
+
+MARK = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def _mark(session_factory, property_id):
+    db = session_factory()
+    try:
+        db.execute(update(models.Property).where(models.Property.id == property_id).values(updated_at=MARK))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _updated_at(session_factory, property_id):
+    db = session_factory()
+    try:
+        value = db.query(models.Property.updated_at).filter(models.Property.id == property_id).scalar()
+    finally:
+        db.close()
+    return value.replace(tzinfo=timezone.utc) if value is not None and value.tzinfo is None else value
+
+
+def check_lock_row(session_factory, property_id):
+    db = session_factory()
+    try:
+        crud._lock_row(db, models.Property, property_id)
+        db.commit()
+    finally:
+        db.close()
+
+
+def check_calendar_event(session_factory, property_id, realtor_id):
+    # Проверка конфликтов блокирует строку объекта, но сам объект не меняет
+    db = session_factory()
+    try:
+        start = datetime.now(timezone.utc) + timedelta(days=1)
+        crud.create_calendar_event(db, schemas.CalendarEventCreate(
+            property_id=property_id, title="check", start_time=start, end_time=start + timedelta(hours=1),
+        ), realtor_id)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка, что блокировки строк не меняют данные")
+    parser.add_argument("--url", required=True, help="URL отдельной БД для прогона")
+    args = parser.parse_args()
+
+    engine = make_engine(args.url)
+    migrations.upgrade(engine, log=lambda message: None)
+    session_factory = sessionmaker(bind=engine, autoflush=False)
+
+    db = session_factory()
+    run = int(time.time())
+    agency = models.Agency(name=f"check-locks-{run}")
+    db.add(agency)
+    db.flush()
+    realtor = models.Realtor(email=f"check-locks-{run}@example.com", agency_id=agency.id)
+    db.add(realtor)
+    db.flush()
+    db_property = models.Property(
+        title="check", price=1, address="-", agency_id=agency.id, realtor_id=realtor.id,
+    )
+    db.add(db_property)
+    db.commit()
+    property_id, realtor_id = db_property.id, realtor.id
+    db.close()
+
+    checks = [
+        ("_lock_row(Property)", lambda: check_lock_row(session_factory, property_id)),
+        ("create_calendar_event", lambda: check_calendar_event(session_factory, property_id, realtor_id)),
+    ]
+    failed = 0
+    for name, check in checks:
+        _mark(session_factory, property_id)
+        check()
+        updated_at = _updated_at(session_factory, property_id)
+        if updated_at == MARK:
+            print(f"OK: {name}")
+        else:
+            failed += 1
+            print(f"НАРУШЕНИЕ: {name} изменил updated_at объекта: {updated_at}")
+    engine.dispose()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,11 @@
-from app import crud, models, schemas
+from app import crud, migrations, models, schemas
 from app.database import SessionLocal, engine
 
 def create_super_user():
-    print("Создание таблиц в базе данных...")
-    # Эта строка создаст все таблицы (agencies, realtors, и т.д.)
-    models.Base.metadata.create_all(bind=engine)
-    print("Таблицы успешно созданы.")
+    print("Применение миграций схемы БД...")
+    # Создаст все таблицы (agencies, realtors, и т.д.), если их еще нет
+    migrations.upgrade(engine)
+    print("Схема БД актуальна.")
 
     db = SessionLocal()
     try:
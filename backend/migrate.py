@@ -0,0 +1,20 @@
+import sys
+
+from app import migrations
+from app.database import engine
+
+def migrate():
+    if "--status" in sys.argv:
+        pending = migrations.pending(engine)
+        for version, name in pending:
+            print(f"Не применена: {version:04d}_{name}")
+        if not pending:
+            print("Схема БД актуальна.")
+        return
+
+    print("Применение миграций схемы БД...")
+    applied = migrations.upgrade(engine)
+    print(f"Готово: применено миграций - {len(applied)}.")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,31 @@
+import argparse
+from datetime import timedelta
+
+from app import crud, migrations, rollups
+from app.database import SessionLocal, engine
+
+# Запускать по расписанию (например, раз в сутки из cron), чтобы таблица
+# уведомлений не росла без ограничений.
+
+def purge_notifications():
+    parser = argparse.ArgumentParser(description="Удаление старых уведомлений")
+    parser.add_argument("--read-days", type=int, default=90, help="хранить прочитанные, дней")
+    parser.add_argument("--unread-days", type=int, default=365, help="хранить непрочитанные, дней")
+    args = parser.parse_args()
+
+    migrations.upgrade(engine)
+
+    now = rollups.utcnow()
+    db = SessionLocal()
+    try:
+        deleted = crud.purge_notifications(
+            db,
+            read_before=now - timedelta(days=args.read_days),
+            unread_before=now - timedelta(days=args.unread_days),
+        )
+        print(f"Удалено уведомлений: {deleted}.")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    purge_notifications()
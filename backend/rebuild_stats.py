@@ -0,0 +1,19 @@
+from app import migrations, models, rollups
+from app.database import SessionLocal, engine
+
+def rebuild_stats():
+    # Таблицы сводок могут еще не существовать, если миграции не применялись
+    migrations.upgrade(engine)
+
+    db = SessionLocal()
+    try:
+        print("Пересчет сводной статистики риэлторов и агентств...")
+        rollups.rebuild(db)
+        realtors = db.query(models.StatsRollup).filter(models.StatsRollup.scope == rollups.SCOPE_REALTOR).count()
+        agencies = db.query(models.StatsRollup).filter(models.StatsRollup.scope == rollups.SCOPE_AGENCY).count()
+        print(f"Готово: риэлторов - {realtors}, агентств - {agencies}.")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    rebuild_stats()